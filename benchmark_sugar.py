@@ -0,0 +1,337 @@
+"""
+Benchmarks for pytest-sugar's reporting hot paths.
+
+The benchmarks drive SugarTerminalReporter directly with synthetic reports,
+so they measure only the time spent in the plugin. Run them with:
+
+    python benchmark_sugar.py [--count N] [--max-ratio R] [name ...]
+
+--count sets the number of tests of the overhead benchmark, which compares
+pytest-sugar with pytest's own TerminalReporter. With --max-ratio, the
+script fails if pytest-sugar takes more than R times as long as pytest.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+os.environ["PYTEST_DISABLE_PLUGIN_AUTOLOAD"] = "1"
+
+from _pytest.config import _prepareconfig  # noqa: E402
+from _pytest.main import Session  # noqa: E402
+from _pytest.reports import CollectReport, TestReport  # noqa: E402
+from _pytest.terminal import TerminalReporter  # noqa: E402
+
+import pytest_sugar  # noqa: E402
+
+
+class NullTerminal(io.StringIO):
+    """Terminal that only counts the bytes written to it."""
+
+    written = 0
+
+    def write(self, s: str) -> int:
+        self.written += len(s.encode("utf-8"))
+        return len(s)
+
+
+class FakeGateway:
+    def __init__(self, worker_id: str) -> None:
+        self.id = worker_id
+
+
+class FakeNode:
+    """Stands in for the worker that ran a test under pytest-xdist."""
+
+    def __init__(self, worker_id: str) -> None:
+        self.gateway = FakeGateway(worker_id)
+
+
+def make_session(*args: str) -> Session:
+    config = _prepareconfig(
+        ["-p", "pytest_sugar", "-p", "no:cacheprovider", "-s", "--force-sugar", *args]
+    )
+    config._do_configure()
+    return Session.from_config(config)
+
+
+def make_reporter(session: Session) -> pytest_sugar.SugarTerminalReporter:
+    reporter = pytest_sugar.SugarTerminalReporter(session.config, file=NullTerminal())
+    pytest_sugar.pytest_sessionstart(session)
+    reporter.pytest_sessionstart(session)
+    return reporter
+
+
+def module_path(i: int, files: int, path_depth: int) -> str:
+    parts = ["tests"] + ["package_%d" % depth for depth in range(path_depth)]
+    return "/".join(parts + ["test_module_%d.py" % (i % files)])
+
+
+def iter_reports(
+    count: int,
+    fail_every: int = 0,
+    files: int = 100,
+    captured: int = 0,
+    name_length: int = 0,
+    path_depth: int = 0,
+    workers: int = 0,
+) -> Iterator[List[TestReport]]:
+    """Yields setup, call and teardown reports for count synthetic tests.
+
+    Reports are created lazily so that only the reporter keeps them alive.
+    With workers set, reports look like they came from pytest-xdist workers.
+    """
+    for i in range(count):
+        sections = []
+        if captured:
+            sections.append(("Captured stdout call", "%d" % i + "x" * captured))
+        path = module_path(i, files, path_depth)
+        name = "test_%d" % i
+        if name_length:
+            name = "%s[%s]" % (name, "x" * name_length)
+        nodeid = "%s::%s" % (path, name)
+        location = (path, i, name)
+        if fail_every and i % fail_every == 0:
+            outcome, longrepr = "failed", "E       assert %d == 0" % i
+        else:
+            outcome, longrepr = "passed", None
+        reports = [
+            TestReport(nodeid, location, {}, "passed", None, "setup"),
+            TestReport(nodeid, location, {}, outcome, longrepr, "call", sections),
+            TestReport(nodeid, location, {}, "passed", None, "teardown"),
+        ]
+        if workers:
+            node = FakeNode("gw%d" % (i % workers))
+            for report in reports:
+                report.node = node  # type: ignore[attr-defined]
+        yield reports
+
+
+def iter_collect_reports(files: int, path_depth: int = 0) -> Iterator[CollectReport]:
+    for i in range(files):
+        yield CollectReport(module_path(i, files, path_depth), "passed", None, [])
+
+
+def feed(
+    reporter: TerminalReporter,
+    count: int,
+    tests: Iterable[List[TestReport]],
+) -> None:
+    if isinstance(reporter, pytest_sugar.SugarTerminalReporter):
+        reporter.tests_count = count
+    for reports in tests:
+        for report in reports:
+            reporter.pytest_runtest_logreport(report)
+
+
+def bench_summary_stats() -> Dict[str, float]:
+    """Time summary_stats after sessions of increasing size."""
+    results = {}
+    session = make_session("--tb=no")
+    for count in (1_000, 10_000, 100_000):
+        reporter = make_reporter(session)
+        feed(reporter, count, iter_reports(count, fail_every=count // 10))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            reporter.summary_stats()
+        results["%d tests" % count] = time.perf_counter() - start
+    session.config._ensure_unconfigure()
+    return results
+
+
+def bench_long_lines() -> Dict[str, float]:
+    """Per-test reporting time with long status lines."""
+    results = {}
+    count = 20_000
+    for label, args, name_length in (
+        ("default", (), 0),
+        ("verbose, 200 char names", ("-v",), 200),
+    ):
+        session = make_session("--tb=no", *args)
+        reporter = make_reporter(session)
+        reports = list(iter_reports(count, files=1, name_length=name_length))
+        start = time.perf_counter()
+        feed(reporter, count, reports)
+        results["%s (per test)" % label] = (time.perf_counter() - start) / count
+        session.config._ensure_unconfigure()
+    return results
+
+
+def bench_retention() -> Dict[str, float]:
+    """Memory retained by the reporter for tests with 10 kB of captured output."""
+    results = {}
+    count = 20_000
+    for retention in ("full", "summary"):
+        session = make_session("--tb=no", "--sugar-retention", retention)
+        reporter = make_reporter(session)
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            feed(reporter, count, iter_reports(count, captured=10_000))
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["%s retention (MB)" % retention] = retained / 1e6
+        session.config._ensure_unconfigure()
+    return results
+
+
+def bench_records() -> Dict[str, float]:
+    """Memory retained by the reporter per 100k tests without captured output."""
+    results = {}
+    count = 100_000
+    for retention in ("full", "summary"):
+        session = make_session("--tb=no", "--sugar-retention", retention)
+        reporter = make_reporter(session)
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            feed(reporter, count, iter_reports(count, files=1000))
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results["%s retention (MB per 100k tests)" % retention] = retained / 1e6
+        session.config._ensure_unconfigure()
+    return results
+
+
+def bench_history() -> Dict[str, float]:
+    """Duration history lookups with 100k cached nodeids."""
+    results = {}
+    count = 100_000
+    session = make_session("--tb=no", "--sugar-eta")
+    history = pytest_sugar.DurationHistory(session.config)
+    history._cache = None
+    tests = list(iter_reports(count))
+    nodeids = [reports[0].nodeid for reports in tests]
+    history.durations = {nodeid: 0.01 for nodeid in nodeids}
+
+    start = time.perf_counter()
+    history.start(nodeids)
+    results["start (total)"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for reports in tests:
+        for report in reports:
+            history.record(report)
+        history.time_left(1.0)
+    results["record and estimate (per test)"] = (time.perf_counter() - start) / count
+    session.config._ensure_unconfigure()
+    return results
+
+
+# Name, command line arguments and arguments of iter_reports
+SCENARIOS: List[Tuple[str, Tuple[str, ...], Dict[str, Any]]] = [
+    ("passing", (), {}),
+    ("1% failing", ("--tb=short",), {"fail_every": 100}),
+    ("long paths", (), {"path_depth": 12, "name_length": 60}),
+    ("verbose", ("-v",), {}),
+    ("xdist", (), {"workers": 32}),
+]
+
+
+def run_session(
+    session: Session, count: int, sugar: bool, kwargs: Dict[str, Any]
+) -> TerminalReporter:
+    """Runs a synthetic session and returns the reporter that showed it."""
+    reporter: TerminalReporter
+    if sugar:
+        reporter = make_reporter(session)
+    else:
+        reporter = TerminalReporter(session.config, file=NullTerminal())
+        reporter.pytest_sessionstart(session)
+    files = kwargs.get("files", 100)
+    for collect_report in iter_collect_reports(files, kwargs.get("path_depth", 0)):
+        reporter.pytest_collectreport(collect_report)
+    session.testscollected = count
+    with contextlib.redirect_stdout(io.StringIO()):
+        for reports in iter_reports(count, **kwargs):
+            nodeid, location = reports[0].nodeid, reports[0].location
+            reporter.pytest_runtest_logstart(nodeid, location)
+            feed(reporter, count, [reports])
+            if sugar:
+                reporter.pytest_runtest_logfinish(nodeid)
+        reporter.summary_stats()
+    return reporter
+
+
+def bench_overhead(count: int) -> Dict[str, float]:
+    """Per-test time, bytes written and peak memory of both reporters."""
+    results = {}
+    for scenario, args, kwargs in SCENARIOS:
+        session = make_session(*args)
+        for name, sugar in (("pytest", False), ("sugar", True)):
+            start = time.perf_counter()
+            reporter = run_session(session, count, sugar, kwargs)
+            elapsed = time.perf_counter() - start
+            results[f"{scenario}: {name} (per test)"] = elapsed / count
+            file = reporter._tw._file
+            assert isinstance(file, NullTerminal)
+            results[f"{scenario}: {name} written (kB)"] = file.written / 1e3
+
+            del reporter
+            tracemalloc.start()
+            reporter = run_session(session, count, sugar, kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[f"{scenario}: {name} peak (MB)"] = peak / 1e6
+            del reporter
+        session.config._ensure_unconfigure()
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[..., Dict[str, float]]] = {
+    "summary_stats": bench_summary_stats,
+    "retention": bench_retention,
+    "records": bench_records,
+    "long_lines": bench_long_lines,
+    "history": bench_history,
+    "overhead": bench_overhead,
+}
+
+
+def format_value(label: str, value: float) -> str:
+    if "(MB" in label or label.endswith("(kB)"):
+        return f"{value:10.3f}"
+    return f"{value * 1000:10.3f} ms"
+
+
+def slowdowns(results: Dict[str, float]) -> Dict[str, float]:
+    """Returns how many times slower pytest-sugar was in each scenario."""
+    ratios = {}
+    for scenario, _, _ in SCENARIOS:
+        stock = results.get(f"{scenario}: pytest (per test)")
+        sugar = results.get(f"{scenario}: sugar (per test)")
+        if stock and sugar:
+            ratios[scenario] = sugar / stock
+    return ratios
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--count", type=int, default=10_000)
+    parser.add_argument("--max-ratio", type=float, default=None)
+    parser.add_argument("names", nargs="*", metavar="name")
+    options = parser.parse_args(argv)
+    for name in options.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+
+    status = 0
+    for name in options.names or BENCHMARKS:
+        if name == "overhead":
+            results = BENCHMARKS[name](options.count)
+        else:
+            results = BENCHMARKS[name]()
+        for label, value in results.items():
+            print(f"{name:<20} {label:<40} {format_value(label, value)}")
+        for scenario, ratio in slowdowns(results).items():
+            print(f"{name:<20} {scenario + ': sugar / pytest':<40} {ratio:10.2f}x")
+            if options.max_ratio is not None and ratio > options.max_ratio:
+                status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
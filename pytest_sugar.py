@@ -9,30 +9,72 @@ and feel of pytest (e.g. progressbar, show tests that fail instantly).
 :license: BSD, see LICENSE for more details.
 """
 
+import contextlib
 import dataclasses
+import functools
+import heapq
+import io
+import json
 import locale
 import os
+import queue
 import re
 import sys
+import threading
 import time
-from configparser import ConfigParser  # type: ignore
-from typing import Any, Dict, Generator, List, Optional, Sequence, TextIO, Tuple, Union
+import traceback
+import unicodedata
+from array import array
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import pytest
+from _pytest._io import TerminalWriter
 from _pytest.config import Config
 from _pytest.config.argparsing import Parser
 from _pytest.main import Session
 from _pytest.nodes import Item
 from _pytest.reports import BaseReport, CollectReport, TestReport
 from _pytest.terminal import TerminalReporter, format_session_duration
-from termcolor import colored
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
 
 __version__ = "1.1.1"
 
 LEN_RIGHT_MARGIN = 0
 LEN_PROGRESS_PERCENTAGE = 5
+LEN_ETA = 8
 LEN_PROGRESS_BAR_SETTING = "10"
 LEN_PROGRESS_BAR: Optional[int] = None
+SUGAR_SETTINGS: Dict[str, str] = {}
+
+
+def colored(text: str, color: Optional[str] = None, *args: Any, **kwargs: Any) -> str:
+    """termcolor.colored, imported on first use.
+
+    termcolor is only needed once there is something to show, so it is not
+    loaded by pytest runs that have pytest-sugar disabled.
+    """
+    global colored
+    from termcolor import colored  # noqa: F811
+
+    return colored(text, color, *args, **kwargs)
 
 
 @dataclasses.dataclass
@@ -60,6 +102,8 @@ class Theme:
     unknown: Optional[str] = "blue"
     symbol_rerun: Optional[str] = "R"
     rerun: Optional[str] = "blue"
+    symbol_regressed: str = "↓"
+    regressed: Optional[str] = "yellow"
 
     def __getitem__(self, x):
         return getattr(self, x)
@@ -85,6 +129,47 @@ PROGRESS_BAR_BLOCKS: List[str] = [
 ]
 
 
+def format_eta(seconds: float) -> str:
+    """Formats an estimated time left in at most LEN_ETA - 1 characters."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "~%ds" % seconds
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return "~%dm%02ds" % (minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return "~%dh%02dm" % (min(hours, 99), minutes)
+
+
+def crash_signature(
+    report: BaseReport,
+) -> Optional[Tuple[str, str, Optional[int], str]]:
+    """Returns the phase, location and message of a failure's crash, if known."""
+    crash = getattr(report.longrepr, "reprcrash", None)
+    if crash is None:
+        return None
+    when = getattr(report, "when", "collect")
+    return (when, crash.path, crash.lineno, crash.message)
+
+
+def directory_of(nodeid: str) -> str:
+    """Returns the directory of a test's file, relative to the rootdir."""
+    return nodeid.split("::", 1)[0].rpartition("/")[0]
+
+
+def format_thread_stacks() -> List[str]:
+    """Returns the current stack of every thread but the calling one."""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        if ident == threading.get_ident():
+            continue
+        lines.append("Thread %s:" % names.get(ident, ident))
+        for entry in traceback.format_stack(frame):
+            lines.extend(entry.rstrip("\n").splitlines())
+    return lines
+
+
 def flatten(seq) -> Generator[Any, None, None]:
     for x in seq:
         if isinstance(x, (list, tuple)):
@@ -93,17 +178,129 @@ def flatten(seq) -> Generator[Any, None, None]:
             yield x
 
 
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parses a shard given as INDEX/COUNT, with INDEX counted from 1."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise pytest.UsageError(
+            "--sugar-shard expects INDEX/COUNT, e.g. 1/4, got %r" % value
+        ) from None
+    if not 1 <= index <= count:
+        raise pytest.UsageError(
+            "--sugar-shard index must be between 1 and %d, got %d" % (count, index)
+        )
+    return index, count
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(config: Config, items: List[Item]) -> None:
+    # Sharding applies even without sugar, or every CI job would run everything
+    shards = config.pluginmanager.getplugin("sugar-shard")
+    if shards is not None and shards.shard is not None:
+        selected, deselected = shards.split(items)
+        items[:] = selected
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+    if IS_SUGAR_ENABLED and get_flag(config, "failed_first"):
+        reporter = config.pluginmanager.getplugin("terminalreporter")
+        history = getattr(reporter, "history", None)
+        if history is None:
+            history = DurationHistory(config)
+        items[:] = history.order(items)
+
+
 def pytest_collection_finish(session: Session) -> None:
     reporter = session.config.pluginmanager.getplugin("terminalreporter")
     if reporter:
         reporter.tests_count = len(session.items)
+    if isinstance(reporter, SugarTerminalReporter):
+        if reporter.history is not None:
+            reporter.history.start(item.nodeid for item in session.items)
+        if reporter.directories is not None:
+            reporter.count_directory_tests(item.nodeid for item in session.items)
+        if reporter.events is not None:
+            reporter.events.emit("collection", tests_count=reporter.tests_count)
+
+
+def pytest_sessionfinish(session: Session, exitstatus: int) -> None:
+    reporter = session.config.pluginmanager.getplugin("terminalreporter")
+    if isinstance(reporter, SugarTerminalReporter):
+        if reporter.watchdog is not None:
+            reporter.watchdog.stop()
+        reporter.stop_frame_timer()
+        if reporter.thread_file is not None:
+            reporter.thread_file.close()
+            reporter.thread_file = None
+        reporter.stop_failure_formatter()
+        reporter.flush_progress()
+        if reporter.history is not None:
+            reporter.history.save()
+        if reporter.baseline is not None:
+            reporter.baseline.save()
+        if reporter.events is not None:
+            reporter.events.emit(
+                "session_finish",
+                exitstatus=int(exitstatus),
+                duration=round(time.time() - reporter._sessionstarttime, 3),
+                counts={
+                    outcome: count
+                    for outcome, count in reporter.outcome_totals().items()
+                    if count
+                },
+            )
+            reporter.events.close()
+            reporter.events = None
+
+
+def pytest_unconfigure(config: Config) -> None:
+    reporter = config.pluginmanager.getplugin("terminalreporter")
+    if isinstance(reporter, SugarTerminalReporter):
+        if reporter.profile is not None:
+            reporter.summary_profile()
+        reporter.stop_async_output()
 
 
 class DeferredXdistPlugin:
+    def __init__(self) -> None:
+        # Number of tests collected by each worker
+        self.collected: Dict[str, int] = {}
+
     def pytest_xdist_node_collection_finished(self, node, ids) -> None:
         terminal_reporter = node.config.pluginmanager.getplugin("terminalreporter")
         if terminal_reporter:
-            terminal_reporter.tests_count = len(ids)
+            self.collected[node.gateway.id] = len(ids)
+            if node.config.getvalue("dist") == "each":
+                # Every worker runs all of the tests
+                terminal_reporter.tests_count = sum(self.collected.values())
+            else:
+                terminal_reporter.tests_count = len(ids)
+        if isinstance(terminal_reporter, SugarTerminalReporter):
+            if terminal_reporter.history is not None:
+                terminal_reporter.history.start(ids)
+            if terminal_reporter.directories is not None:
+                terminal_reporter.count_directory_tests(ids)
+            if terminal_reporter.events is not None:
+                terminal_reporter.events.emit(
+                    "collection",
+                    tests_count=terminal_reporter.tests_count,
+                    worker=node.gateway.id,
+                )
+
+    def pytest_testnodeready(self, node) -> None:
+        terminal_reporter = node.config.pluginmanager.getplugin("terminalreporter")
+        if getattr(terminal_reporter, "lanes", None) is not None:
+            terminal_reporter.lanes.ready(node.gateway.id)
+
+    def pytest_testnodedown(self, node, error) -> None:
+        terminal_reporter = node.config.pluginmanager.getplugin("terminalreporter")
+        if error and getattr(terminal_reporter, "lanes", None) is not None:
+            terminal_reporter.lanes.down(node.gateway.id)
+        shards = node.config.pluginmanager.getplugin("sugar-shard")
+        if shards is not None:
+            # The workers split the tests, the controller saves the durations
+            workeroutput = getattr(node, "workeroutput", {})
+            shards.other_shards.update(workeroutput.get("sugar_other_shards", ()))
 
 
 def pytest_deselected(items: Sequence[Item]) -> None:
@@ -148,10 +345,250 @@ def pytest_addoption(parser: Parser) -> None:
         default=False,
         help=("Disable Playwright trace file detection and display"),
     )
+    group._addoption(
+        "--sugar-fps",
+        action="store",
+        dest="sugar_fps",
+        type=float,
+        default=None,
+        metavar="N",
+        help=("Redraw progress at most N times per second (default: 0, no limit)"),
+    )
+    group._addoption(
+        "--sugar-retention",
+        action="store",
+        dest="sugar_retention",
+        choices=("full", "summary"),
+        default=None,
+        help=(
+            "Keep full reports of passed tests (full, default) or only what "
+            "the summary needs (summary)"
+        ),
+    )
+    group._addoption(
+        "--sugar-eta",
+        action="store_true",
+        dest="sugar_eta",
+        default=False,
+        help=(
+            "Weight the progress bar by test durations of previous runs "
+            "and show the estimated time left"
+        ),
+    )
+    group._addoption(
+        "--sugar-failed-first",
+        action="store_true",
+        dest="sugar_failed_first",
+        default=False,
+        help=(
+            "Run test files that had failures in previous runs first, then "
+            "the others from the fastest to the slowest"
+        ),
+    )
+    group._addoption(
+        "--sugar-shard",
+        metavar="INDEX/COUNT",
+        dest="sugar_shard",
+        default=None,
+        help=(
+            "Split the tests into COUNT shards of about the same duration and "
+            "run only shard INDEX, counting from 1"
+        ),
+    )
+    group._addoption(
+        "--sugar-shard-durations",
+        metavar="PATH",
+        dest="sugar_shard_durations",
+        default=None,
+        help=(
+            "JSON file with the durations of the tests, the same for all shards. "
+            "The durations of the tests that ran are saved to it"
+        ),
+    )
+    group._addoption(
+        "--sugar-resources",
+        action="store_true",
+        dest="sugar_resources",
+        default=False,
+        help=(
+            "Measure the memory and CPU time used by each test and show the "
+            "tests and files that used the most"
+        ),
+    )
+    group._addoption(
+        "--sugar-save-baseline",
+        action="store_true",
+        dest="sugar_save_baseline",
+        default=False,
+        help=(
+            "Save the durations of this run as the baseline that later runs "
+            "are compared with to find tests that got slower"
+        ),
+    )
+    group._addoption(
+        "--sugar-regression-factor",
+        metavar="FACTOR",
+        dest="sugar_regression_factor",
+        default=None,
+        help=(
+            "Report tests whose setup, call or teardown takes FACTOR times "
+            "longer than in the baseline (default: 2)"
+        ),
+    )
+    group._addoption(
+        "--sugar-regression-min",
+        metavar="SECONDS",
+        dest="sugar_regression_min",
+        default=None,
+        help=(
+            "Ignore slowdowns of less than SECONDS compared with the baseline "
+            "(default: 0.05)"
+        ),
+    )
+    group._addoption(
+        "--sugar-collection",
+        action="store_true",
+        dest="sugar_collection",
+        default=False,
+        help=(
+            "Show the progress of the collection and the files and "
+            "directories that were the slowest to collect"
+        ),
+    )
+    group._addoption(
+        "--sugar-slow",
+        action="store",
+        dest="sugar_slow",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help=(
+            "Show tests still running after SECONDS and list the slowest "
+            "tests in the summary"
+        ),
+    )
+    group._addoption(
+        "--sugar-stall",
+        action="store",
+        dest="sugar_stall",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help=("Show the stacks of all threads when a test runs for SECONDS"),
+    )
+    group._addoption(
+        "--sugar-slowest",
+        action="store",
+        dest="sugar_slowest",
+        type=int,
+        default=None,
+        metavar="N",
+        help=("Number of slowest tests listed with --sugar-slow (default: 5)"),
+    )
+    group._addoption(
+        "--sugar-workers",
+        action="store_true",
+        dest="sugar_workers",
+        default=False,
+        help=("Show the progress of each pytest-xdist worker"),
+    )
+    group._addoption(
+        "--sugar-ci",
+        action="store_true",
+        dest="sugar_ci",
+        default=False,
+        help=(
+            "Use pytest-sugar with output suited for CI logs: progress lines "
+            "are appended instead of redrawn"
+        ),
+    )
+    group._addoption(
+        "--sugar-ci-step",
+        action="store",
+        dest="sugar_ci_step",
+        type=int,
+        default=None,
+        metavar="PERCENT",
+        help=("Write a progress line every PERCENT of the tests (default: 10)"),
+    )
+    group._addoption(
+        "--sugar-ci-interval",
+        action="store",
+        dest="sugar_ci_interval",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help=("Write a progress line at least every SECONDS (default: 60)"),
+    )
+    group._addoption(
+        "--sugar-profile",
+        action="store_true",
+        dest="sugar_profile",
+        default=False,
+        help=("Show how much time pytest-sugar itself took at the end"),
+    )
+    group._addoption(
+        "--sugar-profile-json",
+        action="store",
+        dest="sugar_profile_json",
+        default=None,
+        metavar="PATH",
+        help=("Write the time taken by pytest-sugar to PATH as JSON"),
+    )
+    group._addoption(
+        "--sugar-events",
+        action="store",
+        dest="sugar_events",
+        default=None,
+        metavar="PATH",
+        help=("Write a JSON line for each test to PATH (a file or a FIFO)"),
+    )
+    group._addoption(
+        "--sugar-dedup",
+        action="store_true",
+        dest="sugar_dedup",
+        default=False,
+        help=(
+            "Show the traceback only for the first failure with the same "
+            "crash location and message"
+        ),
+    )
+    group._addoption(
+        "--sugar-tb-thread",
+        action="store_true",
+        dest="sugar_tb_thread",
+        default=False,
+        help=(
+            "Format tracebacks of failures on a background thread while the "
+            "next test runs"
+        ),
+    )
+    group._addoption(
+        "--sugar-directories",
+        action="store_true",
+        dest="sugar_directories",
+        default=False,
+        help=(
+            "Show one line with counts and a small progress bar per directory "
+            "instead of a line per test file"
+        ),
+    )
+    group._addoption(
+        "--sugar-async-output",
+        action="store_true",
+        dest="sugar_async_output",
+        default=False,
+        help=("Write terminal output from a background thread"),
+    )
 
 
+@pytest.hookimpl(tryfirst=True)
 def pytest_sessionstart(session: Session) -> None:
-    global THEME, LEN_PROGRESS_BAR_SETTING
+    global THEME, LEN_PROGRESS_BAR_SETTING, SUGAR_SETTINGS, STATUS_TABLE
+    if not IS_SUGAR_ENABLED:
+        return
+    from configparser import ConfigParser
+
     config = ConfigParser()
     config.read(["pytest-sugar.conf", os.path.expanduser("~/.pytest-sugar.conf")])
 
@@ -173,19 +610,59 @@ def pytest_sessionstart(session: Session) -> None:
     if config.has_option("sugar", "progressbar_length"):
         LEN_PROGRESS_BAR_SETTING = config.get("sugar", "progressbar_length")
 
+    SUGAR_SETTINGS = dict(config.items("sugar")) if config.has_section("sugar") else {}
+
     THEME = Theme(**theme_attributes)  # type: ignore
+    markup = (
+        not os.environ.get("NO_COLOR")
+        and session.config.getoption("color", "auto") != "no"
+    )
+    STATUS_TABLE = StatusTable(THEME, markup)
+    STATUS_TABLE.fill()
+
+
+def get_setting(config: Config, name: str, default: str) -> str:
+    """Returns a setting from the command line or the [sugar] config section."""
+    value = config.getoption("sugar_" + name, None)
+    if value is not None:
+        return str(value)
+    return SUGAR_SETTINGS.get(name, default)
+
+
+def get_flag(config: Config, name: str) -> bool:
+    """Returns whether a flag is set on the command line or in [sugar]."""
+    if config.getoption("sugar_" + name, False):
+        return True
+    return SUGAR_SETTINGS.get(name, "").lower() in ("1", "yes", "true", "on")
+
+
+ANSI_ESCAPE = re.compile(r"\x1b[^m]*m")
+# Characters of node ids that Playwright replaces in trace directory names
+TRACE_NAME_TABLE = str.maketrans(
+    {"/": "-", "\\": "-", "[": "-", "]": None, "_": "-", ".": "-"}
+)
 
 
 def strip_colors(text: str) -> str:
-    ansi_escape = re.compile(r"\x1b[^m]*m")
-    stripped = ansi_escape.sub("", text)
-    return stripped
+    return ANSI_ESCAPE.sub("", text)
 
 
 def real_string_length(string: str) -> int:
     return len(strip_colors(string))
 
 
+def display_width(text: str) -> int:
+    """Returns the number of terminal columns needed to show uncolored text."""
+    if text.isascii():
+        return len(text)
+    width = 0
+    for char in text:
+        if unicodedata.combining(char):
+            continue
+        width += 2 if unicodedata.east_asian_width(char) in ("W", "F") else 1
+    return width
+
+
 IS_SUGAR_ENABLED = False
 
 
@@ -193,7 +670,11 @@ IS_SUGAR_ENABLED = False
 def pytest_configure(config) -> None:
     global IS_SUGAR_ENABLED
 
-    if sys.stdout.isatty() or config.getvalue("force_sugar"):
+    if (
+        sys.stdout.isatty()
+        or config.getvalue("force_sugar")
+        or config.getvalue("sugar_ci")
+    ):
         IS_SUGAR_ENABLED = True
 
     if config.pluginmanager.hasplugin("xdist"):
@@ -204,6 +685,22 @@ def pytest_configure(config) -> None:
         else:
             config.pluginmanager.register(DeferredXdistPlugin())
 
+    # Tests are measured where they run, which is in the workers when running
+    # with pytest-xdist
+    if (
+        config.getoption("sugar_resources", False)
+        and config.pluginmanager.getplugin("dsession") is None
+    ):
+        config.pluginmanager.register(ResourceSampler(), "sugar-resources")
+
+    shard = config.getoption("sugar_shard", None)
+    shard_durations = config.getoption("sugar_shard_durations", None)
+    if shard or shard_durations:
+        config.pluginmanager.register(
+            ShardDurations(parse_shard(shard) if shard else None, shard_durations),
+            "sugar-shard",
+        )
+
     if IS_SUGAR_ENABLED and not getattr(config, "slaveinput", None):
         # Get the standard terminal reporter plugin and replace it with our
         standard_reporter = config.pluginmanager.getplugin("terminalreporter")
@@ -212,38 +709,1256 @@ def pytest_configure(config) -> None:
         config.pluginmanager.register(sugar_reporter, "terminalreporter")
 
 
-def pytest_report_teststatus(report: BaseReport) -> Optional[Tuple[str, str, str]]:
-    if not IS_SUGAR_ENABLED:
-        return None
+class StatusTable:
+    """Category, letter and word of each kind of report, resolved once.
 
-    if report.passed:
-        letter = colored(THEME.symbol_passed, THEME.success)
-    elif report.skipped:
-        letter = colored(THEME.symbol_skipped, THEME.skipped)
-    elif report.failed:
-        letter = colored(THEME.symbol_failed, THEME.fail)
-        if report.when != "call":
-            letter = colored(THEME.symbol_failed_not_call, THEME.fail)
-    elif report.outcome == "rerun":
-        letter = colored(THEME.symbol_rerun, THEME.rerun)
-    else:
-        letter = colored(THEME.symbol_unknown, THEME.unknown)
-
-    if hasattr(report, "wasxfail"):
-        if report.skipped:
-            return (
+    The theme does not change during a session, so the letter for each
+    outcome and phase is colored when the session starts and resolving the
+    status of a report is a dictionary lookup.
+    """
+
+    OUTCOMES = ("passed", "skipped", "failed", "rerun")
+    PHASES = ("setup", "call", "teardown", "collect")
+
+    def __init__(self, theme: Theme, markup: bool = True) -> None:
+        self.theme = theme
+        self.markup = markup
+        self.statuses: Dict[Tuple[str, Optional[str], bool], Tuple[str, str, str]] = {}
+
+    def fill(self) -> None:
+        """Resolves the status of every outcome in every phase up front."""
+        for outcome in self.OUTCOMES:
+            for when in self.PHASES:
+                for wasxfail in (False, True):
+                    self.resolve(outcome, when, wasxfail)
+
+    def lookup(self, report: BaseReport) -> Tuple[str, str, str]:
+        key = (report.outcome, report.when, hasattr(report, "wasxfail"))
+        try:
+            return self.statuses[key]
+        except KeyError:
+            return self.resolve(*key)
+
+    def resolve(
+        self, outcome: str, when: Optional[str], wasxfail: bool
+    ) -> Tuple[str, str, str]:
+        theme = self.theme
+        if wasxfail and outcome == "skipped":
+            status = (
                 "xfailed",
-                colored(THEME.symbol_xfailed_skipped, THEME.xfailed),
+                self.color(theme.symbol_xfailed_skipped, theme.xfailed),
                 "xfail",
             )
-        if report.passed:
-            return (
+        elif wasxfail and outcome == "passed":
+            status = (
                 "xpassed",
-                colored(THEME.symbol_xfailed_failed, THEME.xpassed),
+                self.color(theme.symbol_xfailed_failed, theme.xpassed),
                 "XPASS",
             )
+        else:
+            if outcome == "passed":
+                letter = self.color(theme.symbol_passed, theme.success)
+            elif outcome == "skipped":
+                letter = self.color(theme.symbol_skipped, theme.skipped)
+            elif outcome == "failed":
+                if when == "call":
+                    letter = self.color(theme.symbol_failed, theme.fail)
+                else:
+                    letter = self.color(theme.symbol_failed_not_call, theme.fail)
+            elif outcome == "rerun":
+                letter = self.color(theme.symbol_rerun, theme.rerun)
+            else:
+                letter = self.color(theme.symbol_unknown, theme.unknown)
+            status = (outcome, letter, outcome.upper())
+        self.statuses[(outcome, when, wasxfail)] = status
+        return status
+
+    def color(self, symbol: Optional[str], color: Optional[str]) -> str:
+        if not self.markup:
+            return symbol or ""
+        return colored(symbol, color)
+
+
+STATUS_TABLE = StatusTable(THEME)
+
+
+def pytest_report_teststatus(report: BaseReport) -> Optional[Tuple[str, str, str]]:
+    if not IS_SUGAR_ENABLED:
+        return None
+    return STATUS_TABLE.lookup(report)
+
+
+class ProgressBar:
+    """Progress bar that keeps its rendered cells between frames.
+
+    Each cell is a pre-colored string. When the progress advances or a test
+    fails, only the affected cells are re-colored, so drawing a frame costs
+    the same no matter how many tests have run.
+    """
+
+    def __init__(self, length: int) -> None:
+        self.length = length
+        self.has_failed = False
+        # Visible width of the last rendered frame
+        self.width = 0
+        self._last_block = -1
+        self._fill = (0, 0)
+        # Success state of the test block each cell belongs to, None until
+        # the first block has been marked.
+        self._cell_success: List[Optional[bool]] = [None] * length
+        self._cells: List[str] = [""] * length
+        self._dirty = set(range(length))
+        self._bar = ""
+        self._colored: Dict[Tuple[str, Optional[str], Optional[str]], str] = {}
+
+    def mark(self, block: int, success: bool) -> None:
+        """Records the outcome of a test that falls into the given block."""
+        if not self.length:
+            return
+        block = min(block, self.length - 1)
+        if block == self._last_block:
+            if success or self._cell_success[block] is False:
+                return
+        self._last_block = block
+        if not success:
+            self.has_failed = True
+        # Cells up to the next block share the color of this one
+        for i in range(block, self.length):
+            if self._cell_success[i] is not success:
+                self._cell_success[i] = success
+                self._dirty.add(i)
+
+    def render(
+        self, tests_taken: int, tests_count: int, fraction: Optional[float] = None
+    ) -> str:
+        """Renders the bar, filled by fraction or else by tests_taken."""
+        length = self.length
+        if not length:
+            return ""
+
+        if fraction is not None and tests_taken < tests_count:
+            p = min(max(fraction, 0.0), 1.0)
+        else:
+            p = float(tests_taken) / tests_count if tests_count else 0
+        floored = int(p * length)
+        rem = int(round((p * length - floored) * (len(PROGRESS_BAR_BLOCKS) - 1)))
+        percentage = "%i%% " % round(p * 100)
+        # make sure we only report 100% at the last test
+        if percentage == "100% " and tests_taken < tests_count:
+            percentage = "99% "
+        self.width = len(percentage) + length
+
+        # if at least one block indicates failure,
+        # then the percentage should reflect that
+        if self.has_failed:
+            progressbar = self._color(percentage, THEME.fail)
+        else:
+            progressbar = self._color(percentage, THEME.success)
+
+        if (floored, rem) != self._fill:
+            old_floored = self._fill[0]
+            low = min(old_floored, floored)
+            high = min(max(old_floored, floored), length - 1)
+            self._dirty.update(range(low, high + 1))
+            self._fill = (floored, rem)
+
+        if self._dirty:
+            progressbar_background = THEME.progressbar_background
+            if progressbar_background is None:
+                on_color = None
+            else:
+                on_color = "on_" + progressbar_background
+
+            for i in self._dirty:
+                if i < floored:
+                    char = PROGRESS_BAR_BLOCKS[-1]
+                elif i == floored and rem > 0:
+                    char = PROGRESS_BAR_BLOCKS[rem]
+                else:
+                    char = " "
+                success = self._cell_success[i]
+                if success is None:
+                    theme = None
+                elif success:
+                    theme = THEME.progressbar
+                else:
+                    theme = THEME.progressbar_fail
+                self._cells[i] = self._color(char, theme, on_color)
+            self._dirty.clear()
+            self._bar = "".join(self._cells)
+
+        return progressbar + self._bar
+
+    def _color(
+        self, text: str, color: Optional[str], on_color: Optional[str] = None
+    ) -> str:
+        key = (text, color, on_color)
+        try:
+            return self._colored[key]
+        except KeyError:
+            value = self._colored[key] = colored(text, color, on_color)
+            return value
+
+
+class ReportSummary:
+    """Lightweight stand-in for a passed TestReport.
+
+    Keeps what the results summary needs and drops the captured output,
+    sections and keywords of the original report.
+    """
+
+    __slots__ = ("nodeid", "location", "when", "outcome", "duration")
+
+    longrepr = None
+    sections: Tuple[Tuple[str, str], ...] = ()
+
+    def __init__(
+        self,
+        nodeid: str,
+        location: Tuple[str, Optional[int], str],
+        when: Optional[str],
+        outcome: str,
+        duration: float,
+    ) -> None:
+        self.nodeid = nodeid
+        self.location = location
+        self.when = when
+        self.outcome = outcome
+        self.duration = duration
+
+    @property
+    def passed(self) -> bool:
+        return self.outcome == "passed"
+
+    @property
+    def failed(self) -> bool:
+        return self.outcome == "failed"
+
+    @property
+    def skipped(self) -> bool:
+        return self.outcome == "skipped"
+
+    @property
+    def fspath(self) -> str:
+        return self.nodeid.split("::")[0]
+
+    @property
+    def head_line(self) -> Optional[str]:
+        return self.location[2] if self.location else None
+
+
+REPORT_PHASES = ("setup", "call", "teardown", None)
+REPORT_OUTCOMES = ("passed", "failed", "skipped")
+
+
+class ReportRecords(Sequence[ReportSummary]):
+    """Reports packed into arrays, in place of a list of reports.
+
+    Each report takes a byte for its phase and outcome, four bytes for the
+    index of its test and eight bytes for its duration. Consecutive reports
+    of the same test share the entries of the test, so with the nodeid and
+    location strings owned by the collected items, three passed reports
+    cost about 60 bytes per test. A ReportSummary is made for a report
+    when it is accessed.
+    """
+
+    def __init__(self) -> None:
+        self._nodeids: List[str] = []
+        self._locations: List[Tuple[str, Optional[int], str]] = []
+        self._tests = array("I")
+        self._codes = bytearray()
+        self._durations = array("d")
+
+    def append(self, report: Union[TestReport, ReportSummary]) -> None:
+        nodeids = self._nodeids
+        if not nodeids or nodeids[-1] != report.nodeid:
+            nodeids.append(report.nodeid)
+            self._locations.append(report.location)
+        self._tests.append(len(nodeids) - 1)
+        self._codes.append(
+            REPORT_PHASES.index(report.when) * len(REPORT_OUTCOMES)
+            + REPORT_OUTCOMES.index(report.outcome)
+        )
+        self._durations.append(report.duration)
+
+    def _summary(self, index: int) -> ReportSummary:
+        test = self._tests[index]
+        phase, outcome = divmod(self._codes[index], len(REPORT_OUTCOMES))
+        return ReportSummary(
+            self._nodeids[test],
+            self._locations[test],
+            REPORT_PHASES[phase],
+            REPORT_OUTCOMES[outcome],
+            self._durations[index],
+        )
+
+    def __getitem__(self, index):  # type: ignore[override]
+        if isinstance(index, slice):
+            return [self._summary(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("report index out of range")
+        return self._summary(index)
+
+    def __iter__(self) -> Iterator[ReportSummary]:
+        for index in range(len(self._codes)):
+            yield self._summary(index)
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+
+class DurationHistory:
+    """Test durations and failures from previous runs, kept in pytest's cache.
+
+    Used to weight the progress by how long each test is expected to take,
+    to estimate the time left and to run the tests most likely to fail
+    first. Expected durations are looked up once when collection finishes,
+    so each report only costs a dict lookup.
+    """
+
+    cache_key = "sugar/durations"
+    failed_cache_key = "sugar/failed"
+
+    def __init__(self, config: Config) -> None:
+        self._cache = getattr(config, "cache", None)
+        durations = self._cache.get(self.cache_key, {}) if self._cache else {}
+        self.durations: Dict[str, float] = (
+            durations if isinstance(durations, dict) else {}
+        )
+        failed = self._cache.get(self.failed_cache_key, []) if self._cache else []
+        # Tests that failed the last time they ran
+        self.failed: Set[str] = set(failed) if isinstance(failed, list) else set()
+        self.current: Dict[str, float] = {}
+        self.current_failed: Set[str] = set()
+        self.expected: Dict[str, float] = {}
+        self.expected_total = 0.0
+        self.expected_done = 0.0
+
+    def start(self, nodeids: Iterable[str]) -> None:
+        """Looks up the expected duration of the tests about to run."""
+        durations = self.durations
+        default = self.default_duration()
+        self.expected = {nodeid: durations.get(nodeid, default) for nodeid in nodeids}
+        self.expected_total = sum(self.expected.values())
+        self.expected_done = 0.0
+
+    def default_duration(self) -> float:
+        # Tests without history are expected to take an average time. Without
+        # any history, every test weighs the same.
+        durations = self.durations
+        return sum(durations.values()) / len(durations) if durations else 1.0
+
+    def order(self, items: List[Item]) -> List[Item]:
+        """Orders test files so that failures show up as early as possible.
+
+        Files with tests that failed the last time come first, then the
+        others from the fastest to the slowest. Tests keep their order
+        within a file, so that module fixtures are still set up only once.
+        """
+        files: Dict[str, List[Item]] = {}
+        for item in items:
+            files.setdefault(item.nodeid.split("::", 1)[0], []).append(item)
+        durations = self.durations
+        default = self.default_duration()
+        failed = self.failed
+
+        def key(file_items: List[Item]) -> Tuple[bool, float]:
+            return (
+                not any(item.nodeid in failed for item in file_items),
+                sum(durations.get(item.nodeid, default) for item in file_items),
+            )
+
+        ordered = sorted(files.values(), key=key)
+        return [item for file_items in ordered for item in file_items]
+
+    def record(self, report: TestReport) -> None:
+        nodeid = report.nodeid
+        self.current[nodeid] = self.current.get(nodeid, 0.0) + report.duration
+        if report.failed:
+            self.current_failed.add(nodeid)
+        if report.when == "teardown":
+            self.expected_done += self.expected.pop(nodeid, 0.0)
+
+    @property
+    def fraction(self) -> Optional[float]:
+        """Expected fraction of the total run time done so far."""
+        if not self.expected_total:
+            return None
+        return self.expected_done / self.expected_total
+
+    def time_left(self, elapsed: float) -> Optional[float]:
+        """Estimates the time left from the time elapsed so far.
+
+        The expected durations are scaled by how fast this run has gone so
+        far, which also accounts for running tests in parallel.
+        """
+        if not self.expected_done:
+            return None
+        remaining = self.expected_total - self.expected_done
+        return max(remaining, 0.0) * elapsed / self.expected_done
+
+    def save(self) -> None:
+        if self._cache is None or not self.current:
+            return
+        durations = dict(self.durations)
+        for nodeid, duration in self.current.items():
+            durations[nodeid] = round(duration, 4)
+        self._cache.set(self.cache_key, durations)
+        failed = {nodeid for nodeid in self.failed if nodeid not in self.current}
+        self._cache.set(self.failed_cache_key, sorted(failed | self.current_failed))
+
+
+class ShardDurations:
+    """Splits the tests into shards of about the same duration.
+
+    Every job of a sharded run has to split the tests the same way, so the
+    durations come from one file given to all of them instead of from what
+    each job ran before. The durations of the tests that ran are merged into
+    the file at the end of the session, whether or not pytest-sugar shows
+    the output, without those of the tests of other shards, so that the
+    files of the jobs can be merged. Without durations, every test counts
+    the same.
+    """
+
+    def __init__(self, shard: Optional[Tuple[int, int]], path: Optional[str]) -> None:
+        # Index, counted from 1, and number of shards
+        self.shard = shard
+        self.path = path
+        self.durations = self.load(path) if path else {}
+        self.current: Dict[str, float] = {}
+        # Expected duration of the tests of the shard, if any were known
+        self.predicted: Optional[float] = None
+        # Tests left to the other shards, whose jobs save their durations
+        self.other_shards: Set[str] = set()
+
+    @staticmethod
+    def load(path: str) -> Dict[str, float]:
+        try:
+            with open(path, encoding="utf-8") as file:
+                durations = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            raise pytest.UsageError(
+                "--sugar-shard-durations: cannot read %s: %s" % (path, error)
+            ) from None
+        if not isinstance(durations, dict):
+            raise pytest.UsageError(
+                "--sugar-shard-durations: %s does not map test ids to durations" % path
+            )
+        return durations
+
+    def split(self, items: List[Item]) -> Tuple[List[Item], List[Item]]:
+        """Returns the tests of the shard in their collected order, and the rest.
+
+        Tests are handed out from the slowest to the fastest, each to the
+        shard expected to take the least time so far.
+        """
+        assert self.shard is not None
+        index, count = self.shard
+        durations = self.durations
+        default = sum(durations.values()) / len(durations) if durations else 1.0
+        expected = [durations.get(item.nodeid, default) for item in items]
+        # Expected total and number of each shard
+        totals = [(0.0, shard) for shard in range(count)]
+        assigned = [0] * len(items)
+        for position in sorted(
+            range(len(items)), key=lambda p: (-expected[p], items[p].nodeid)
+        ):
+            total, shard = totals[0]
+            assigned[position] = shard
+            heapq.heapreplace(totals, (total + expected[position], shard))
+
+        selected: List[Item] = []
+        deselected: List[Item] = []
+        predicted = 0.0
+        for item, shard, duration in zip(items, assigned, expected):
+            if shard == index - 1:
+                selected.append(item)
+                predicted += duration
+            else:
+                deselected.append(item)
+        self.predicted = predicted if durations else None
+        self.other_shards = {item.nodeid for item in deselected}
+        return selected, deselected
+
+    def pytest_runtest_logreport(self, report: TestReport) -> None:
+        nodeid = report.nodeid
+        self.current[nodeid] = self.current.get(nodeid, 0.0) + report.duration
+
+    def pytest_sessionfinish(self, session: Session) -> None:
+        # The controller of a pytest-xdist run saves the durations of all tests
+        workeroutput = getattr(session.config, "workeroutput", None)
+        if workeroutput is not None:
+            workeroutput["sugar_other_shards"] = sorted(self.other_shards)
+        elif self.path and self.current:
+            self.save()
+
+    def save(self) -> None:
+        assert self.path is not None
+        other_shards = self.other_shards
+        durations = {
+            nodeid: duration
+            for nodeid, duration in self.durations.items()
+            if nodeid not in other_shards
+        }
+        for nodeid, duration in self.current.items():
+            durations[nodeid] = round(duration, 4)
+        # Written in one go, as other jobs may be reading the file
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(durations, file, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+class DurationBaseline:
+    """Durations of the phases of each test in the run saved as the baseline.
+
+    A phase regressed when it took factor times as long as in the baseline
+    and at least min_seconds longer, so that the noise in the durations of
+    fast tests is ignored.
+    """
+
+    cache_key = "sugar/baseline"
+    PHASES = ("setup", "call", "teardown")
+
+    def __init__(
+        self, config: Config, factor: float, min_seconds: float, save: bool
+    ) -> None:
+        self._cache = getattr(config, "cache", None)
+        baseline = self._cache.get(self.cache_key, {}) if self._cache else {}
+        self.baseline: Dict[str, List[float]] = (
+            baseline if isinstance(baseline, dict) else {}
+        )
+        self.factor = factor
+        self.min_seconds = min_seconds
+        self.save_current = save
+        # Phase durations of this run, only kept when saving the baseline
+        self.current: Dict[str, List[float]] = {}
+        # Baseline and current duration of each regressed (nodeid, phase)
+        self.regressions: Dict[Tuple[str, str], Tuple[float, float]] = {}
+
+    def record(self, report: TestReport) -> None:
+        """Records the duration of a phase and whether it regressed."""
+        try:
+            phase = self.PHASES.index(report.when)
+        except ValueError:
+            return
+        nodeid = report.nodeid
+        if self.save_current:
+            durations = self.current.get(nodeid)
+            if durations is None:
+                durations = self.current[nodeid] = [0.0] * len(self.PHASES)
+            durations[phase] = round(report.duration, 4)
+        before = self.baseline.get(nodeid)
+        if before is None:
+            return
+        try:
+            expected = before[phase]
+        except (IndexError, TypeError):
+            return
+        duration = report.duration
+        slowdown = duration - expected
+        if duration > expected * self.factor and slowdown >= self.min_seconds:
+            self.regressions[(nodeid, report.when)] = (expected, duration)
+
+    def is_regressed(self, nodeid: str, phases: Sequence[str]) -> bool:
+        return any((nodeid, when) in self.regressions for when in phases)
+
+    def biggest(self, count: int) -> List[Tuple[str, str, float, float]]:
+        """Returns the regressions that added the most time, the biggest first."""
+        return [
+            (nodeid, when, expected, duration)
+            for (nodeid, when), (expected, duration) in heapq.nlargest(
+                count,
+                self.regressions.items(),
+                key=lambda entry: entry[1][1] - entry[1][0],
+            )
+        ]
+
+    def save(self) -> None:
+        if self._cache is None or not self.current:
+            return
+        baseline = dict(self.baseline)
+        baseline.update(self.current)
+        self._cache.set(self.cache_key, baseline)
+
+
+class Watchdog:
+    """Keeps track of running tests and checks on them from a thread.
+
+    Tests running longer than slow seconds are shown once, and the stacks
+    of all threads are shown once for tests running longer than stall
+    seconds. The slowest finished tests are kept in a small heap, shown
+    along with the notices for slow tests whenever it has changed. With
+    idle set, pytest-xdist workers without a test to run are checked too.
+    """
+
+    def __init__(
+        self,
+        reporter: "SugarTerminalReporter",
+        slow: float,
+        stall: float,
+        slowest: int,
+        idle: float = 0.0,
+    ) -> None:
+        self.reporter = reporter
+        self.slow = slow
+        self.stall = stall
+        self.idle = idle
+        self.slowest_count = slowest
+        # Durations and nodeids of the slowest tests, the fastest first
+        self.slowest: List[Tuple[float, str]] = []
+        self._shown_slowest: List[Tuple[float, str]] = []
+        self.running: Dict[str, float] = {}
+        self._shown_slow: set = set()
+        self._shown_stall: set = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        limits = [limit for limit in (slow, stall, idle) if limit > 0]
+        self.interval = min(max(min(limits) / 10, 0.05), 1.0) if limits else 1.0
+        self._thread = threading.Thread(
+            target=self._run, name="pytest-sugar-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def start_test(self, nodeid: str) -> None:
+        with self._lock:
+            self.running[nodeid] = time.monotonic()
+
+    def finish_test(self, nodeid: str) -> None:
+        with self._lock:
+            started = self.running.pop(nodeid, None)
+            self._shown_slow.discard(nodeid)
+            self._shown_stall.discard(nodeid)
+            if started is None or not self.slowest_count:
+                return
+            entry = (time.monotonic() - started, nodeid)
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def check(self) -> None:
+        now = time.monotonic()
+        slow = []
+        stalled = []
+        with self._lock:
+            for nodeid, started in self.running.items():
+                elapsed = now - started
+                if self.stall and elapsed >= self.stall:
+                    if nodeid not in self._shown_stall:
+                        self._shown_stall.add(nodeid)
+                        self._shown_slow.add(nodeid)
+                        stalled.append((nodeid, elapsed))
+                elif self.slow and elapsed >= self.slow:
+                    if nodeid not in self._shown_slow:
+                        self._shown_slow.add(nodeid)
+                        slow.append((nodeid, elapsed))
+            slowest = sorted(self.slowest, reverse=True)
+        for nodeid, elapsed in slow:
+            self.reporter.show_slow_test(nodeid, elapsed)
+        if slow and slowest and slowest != self._shown_slowest:
+            self._shown_slowest = slowest
+            self.reporter.show_slowest_tests(slowest)
+        for nodeid, elapsed in stalled:
+            self.reporter.show_stalled_test(nodeid, elapsed)
+        if self.idle:
+            self.reporter.show_idle_workers()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+
+class CountedFile:
+    """File-like object that counts what is written to another file."""
+
+    def __init__(self, file: TextIO, profile: "ReporterProfile") -> None:
+        self.file = file
+        self.profile = profile
+
+    def write(self, data: str) -> int:
+        self.profile.writes += 1
+        self.profile.bytes_written += len(data.encode("utf-8", "replace"))
+        return self.file.write(data)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.file, name)
+
+
+class ReporterProfile:
+    """Counts calls to the reporter's hot paths and the time spent in them.
+
+    Self time excludes the time spent in other profiled methods called
+    from a method, so the self times add up to the time of the plugin.
+    Bytes written to the terminal are counted as well.
+    """
+
+    methods = (
+        "pytest_collectreport",
+        "pytest_runtest_logreport",
+        "insert_progress",
+        "begin_new_line",
+        "print_failure",
+        "summary_stats",
+    )
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = dict.fromkeys(self.methods, 0)
+        self.total_times: Dict[str, float] = dict.fromkeys(self.methods, 0.0)
+        self.self_times: Dict[str, float] = dict.fromkeys(self.methods, 0.0)
+        self.bytes_written = 0
+        self.writes = 0
+        # Time spent in profiled methods called by each running method
+        self._children: List[float] = []
+
+    def instrument(self, reporter: "SugarTerminalReporter") -> None:
+        """Replaces the reporter's methods with profiled ones.
+
+        Must be done before the reporter is registered, as pluggy keeps
+        references to the hook methods.
+        """
+        for name in self.methods:
+            setattr(reporter, name, self.wrap(name, getattr(reporter, name)))
+        reporter._tw._file = CountedFile(reporter._tw._file, self)
+
+    def wrap(self, name: str, method: Any) -> Any:
+        children = self._children
+
+        # Keeps the signature, which pluggy uses to pass hook arguments
+        @functools.wraps(method)
+        def profiled(*args: Any, **kwargs: Any) -> Any:
+            children.append(0.0)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.calls[name] += 1
+                self.total_times[name] += elapsed
+                self.self_times[name] += elapsed - children.pop()
+                if children:
+                    children[-1] += elapsed
+
+        return profiled
+
+    @property
+    def total(self) -> float:
+        return sum(self.self_times.values())
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "methods": {
+                name: {
+                    "calls": self.calls[name],
+                    "total": self.total_times[name],
+                    "self": self.self_times[name],
+                }
+                for name in self.methods
+            },
+            "total": self.total,
+            "bytes_written": self.bytes_written,
+            "writes": self.writes,
+        }
+
+
+class ResourceSampler:
+    """Measures the CPU time and memory used by each test.
+
+    Registered in the process that runs the tests. Readings are taken when
+    a test starts and after its teardown, and attached to the teardown
+    report so that they also reach the controller of a pytest-xdist run.
+    """
+
+    def __init__(self) -> None:
+        try:
+            import resource
+        except ImportError:
+            # Not available on Windows
+            self._resource = None
+        else:
+            self._resource = resource
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        self._maxrss_unit = 1 if sys.platform == "darwin" else 1024
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 0
+        self._start: Optional[Tuple[float, float, int, int]] = None
+
+    def read(self) -> Tuple[float, float, int, int]:
+        """Returns the wall time, CPU time, RSS and peak RSS of the process."""
+        peak = 0
+        if self._resource is not None:
+            usage = self._resource.getrusage(self._resource.RUSAGE_SELF)
+            peak = usage.ru_maxrss * self._maxrss_unit
+        try:
+            with open("/proc/self/statm", "rb") as f:
+                rss = int(f.read().split()[1]) * self._page_size
+        except (OSError, ValueError, IndexError):
+            # Without /proc, the peak is the closest thing to the RSS
+            rss = peak
+        return time.perf_counter(), time.process_time(), rss, peak
+
+    def pytest_runtest_logstart(self, nodeid: str, location) -> None:
+        self._start = self.read()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item: Item, call) -> Generator:
+        outcome = yield
+        if call.when != "teardown" or self._start is None:
+            return
+        report = outcome.get_result()
+        wall, cpu, rss, peak = self.read()
+        start_wall, start_cpu, start_rss, _ = self._start
+        self._start = None
+        report.sugar_resources = (
+            cpu - start_cpu,
+            wall - start_wall,
+            rss - start_rss,
+            peak,
+        )
+
+
+class ResourceUsage:
+    """Resources used by the tests, for the results summary.
+
+    Only the tests that used the most of each resource are kept, along with
+    totals per file.
+    """
+
+    def __init__(self, top: int = 5) -> None:
+        self.top = top
+        # Smallest first, as kept by heapq
+        self.memory: List[Tuple[int, str]] = []
+        self.cpu: List[Tuple[float, float, str]] = []
+        # CPU time, wall time and RSS growth per file
+        self.files: Dict[str, List[float]] = {}
+        # Highest peak RSS of the processes that ran tests
+        self.peak = 0
+
+    def record(self, nodeid: str, cpu: float, wall: float, rss: int, peak: int) -> None:
+        self.peak = max(self.peak, peak)
+        self._keep(self.memory, (rss, nodeid))
+        self._keep(self.cpu, (cpu, wall, nodeid))
+        path = nodeid.split("::", 1)[0]
+        totals = self.files.get(path)
+        if totals is None:
+            totals = self.files[path] = [0.0, 0.0, 0.0]
+        totals[0] += cpu
+        totals[1] += wall
+        totals[2] += rss
+
+    def _keep(self, heap: List[Any], entry: Tuple[Any, ...]) -> None:
+        if len(heap) < self.top:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def top_files(self) -> List[Tuple[str, List[float]]]:
+        """Returns the files whose tests grew the RSS the most."""
+        return heapq.nlargest(
+            self.top, self.files.items(), key=lambda entry: entry[1][2]
+        )
+
+
+class PlaywrightArtifacts:
+    """Files that Playwright left in a test's output directory."""
+
+    __slots__ = ("trace", "screenshots", "videos")
+
+    def __init__(self) -> None:
+        self.trace: Optional[str] = None
+        self.screenshots: List[str] = []
+        self.videos: List[str] = []
+
+
+class ArtifactIndex:
+    """Index of the per-test output directories of Playwright.
+
+    The directory is scanned once, on the first lookup. As Playwright adds
+    a directory for each failed test while the tests run, a later lookup
+    that misses only looks at the test's own directory. Tests without a
+    directory are remembered until the modification time of the directory
+    changes, and a test's directory without a trace yet is read again only
+    when its own modification time has changed.
+    """
+
+    screenshot_extensions = (".png", ".jpg", ".jpeg")
+    video_extensions = (".webm", ".mp4")
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.entries: Dict[str, PlaywrightArtifacts] = {}
+        self._scanned = False
+        self._entry_mtimes: Dict[str, float] = {}
+        # Modification time of the directory, None while it does not exist
+        self._mtime: Optional[float] = None
+        self._missing: set = set()
+
+    def get(self, name: str) -> Optional[PlaywrightArtifacts]:
+        """Returns the artifacts of the test with the given directory name."""
+        artifacts = self.entries.get(name)
+        if artifacts is not None:
+            if artifacts.trace is None:
+                self.scan_entry(name, os.path.join(self.directory, name))
+            return self.entries[name]
+        try:
+            mtime: Optional[float] = os.stat(self.directory).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            # Directories were added or removed since the misses
+            self._mtime = mtime
+            self._missing.clear()
+        if mtime is None or name in self._missing:
+            return None
+        if self._scanned:
+            self.scan_entry(name, os.path.join(self.directory, name))
+        else:
+            self.scan()
+        if name not in self.entries:
+            self._missing.add(name)
+        return self.entries.get(name)
+
+    def scan(self) -> None:
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        self.scan_entry(entry.name.lower(), entry.path)
+        except OSError:
+            return
+        self._scanned = True
+
+    def scan_entry(self, name: str, path: str) -> None:
+        try:
+            mtime = os.stat(path).st_mtime
+            if self._entry_mtimes.get(name) == mtime:
+                return
+            artifacts = PlaywrightArtifacts()
+            with os.scandir(path) as it:
+                for entry in sorted(it, key=lambda entry: entry.name):
+                    extension = os.path.splitext(entry.name)[1].lower()
+                    if entry.name == "trace.zip":
+                        artifacts.trace = entry.path
+                    elif extension in self.screenshot_extensions:
+                        artifacts.screenshots.append(entry.path)
+                    elif extension in self.video_extensions:
+                        artifacts.videos.append(entry.path)
+        except OSError:
+            return
+        self.entries[name] = artifacts
+        self._entry_mtimes[name] = mtime
+
+
+class EventStream:
+    """Writes events as compact JSON lines, one per line, to a file.
+
+    Lines are buffered and flushed every flush_interval seconds by a
+    background thread, so the file can be followed live, also during a long
+    test, without a system call for every test.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5) -> None:
+        self.file = open(path, "w", encoding="utf-8")
+        self.flush_interval = flush_interval
+        self._encode = json.JSONEncoder(
+            ensure_ascii=False, separators=(",", ":")
+        ).encode
+        self._unflushed = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="pytest-sugar-events", daemon=True
+        )
+        self._thread.start()
+
+    def emit(self, event: str, **data: Any) -> None:
+        data = {"event": event, "time": round(time.time(), 3), **data}
+        line = self._encode(data) + "\n"
+        with self._lock:
+            self.file.write(line)
+            self._unflushed = True
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._unflushed:
+                self._unflushed = False
+                self.file.flush()
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.file.close()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+
+class CollectionStats:
+    """Progress of the collection and time spent collecting each node.
+
+    Files are timed including the import of their module, directories
+    including the import of their conftest.py.
+    """
+
+    # Seconds between redraws of the collection progress
+    frame_interval = 0.1
+    # Collectors that are timed
+    timed = (pytest.File, getattr(pytest, "Directory", pytest.File))
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.last_frame = 0.0
+        self.files = 0
+        self.items = 0
+        # Seconds spent collecting each timed node, by nodeid
+        self.durations: Dict[str, float] = {}
+        # Number of tests collected from each file
+        self.item_counts: Dict[str, int] = {}
+
+    def record(self, report: CollectReport) -> None:
+        items = sum(isinstance(node, Item) for node in report.result)
+        if items:
+            path = report.nodeid.split("::", 1)[0]
+            self.item_counts[path] = self.item_counts.get(path, 0) + items
+            self.items += items
+
+    def slowest(self, count: int) -> List[Tuple[str, float]]:
+        return heapq.nlargest(count, self.durations.items(), key=lambda entry: entry[1])
+
+
+class StatusLine:
+    """A line of test statuses that is redrawn in place."""
+
+    __slots__ = ("num", "text", "width")
+
+    def __init__(self, num: int, text: str, width: int) -> None:
+        # Number of the line counted from the start of the session
+        self.num = num
+        self.text = text
+        # Visible width of the text, kept up to date as letters are added so
+        # that lines never need to be stripped of colors
+        self.width = width
+
+
+class DirectoryStats:
+    """Results of the tests in a directory, for the directory view."""
+
+    __slots__ = ("total", "done", "failed", "letters")
+
+    def __init__(self) -> None:
+        self.total = 0
+        self.done = 0
+        self.failed = False
+        # Number of tests per status letter, in order of first appearance
+        self.letters: Dict[str, int] = {}
+
+
+class WorkerStats:
+    """Progress of a single pytest-xdist worker."""
+
+    __slots__ = ("completed", "failed", "busy", "current", "idle_since", "down")
+
+    def __init__(self, now: float) -> None:
+        self.completed = 0
+        self.failed = 0
+        # Time spent in setup, call and teardown of the tests of the worker
+        self.busy = 0.0
+        self.current: Optional[str] = None
+        self.idle_since: Optional[float] = now
+        self.down = False
+
+
+class WorkerLanes:
+    """Keeps per-worker progress of a session run with pytest-xdist.
+
+    Workers only report on tests once their setup has finished, so a
+    worker counts as idle from the end of a test until the setup report of
+    its next test. Tests that started but have no setup report yet are
+    credited to the workers that became idle most recently.
+    """
+
+    blocks = " ▁▂▃▄▅▆▇█"
+
+    def __init__(self, idle_after: float = 1.0) -> None:
+        self.idle_after = idle_after
+        self.workers: Dict[str, WorkerStats] = {}
+        self.starting: set = set()
+        self._shown_idle: set = set()
+
+    def ready(self, worker_id: str) -> None:
+        self.workers.setdefault(worker_id, WorkerStats(time.monotonic()))
 
-    return report.outcome, letter, report.outcome.upper()
+    def down(self, worker_id: str) -> None:
+        self.ready(worker_id)
+        self.workers[worker_id].down = True
+
+    def start_test(self, nodeid: str) -> None:
+        self.starting.add(nodeid)
+
+    def record(self, report: TestReport) -> None:
+        node = getattr(report, "node", None)
+        if node is None:
+            return
+        worker_id = node.gateway.id
+        self.ready(worker_id)
+        stats = self.workers[worker_id]
+        stats.busy += report.duration
+        if report.when == "setup":
+            self.starting.discard(report.nodeid)
+            stats.current = report.nodeid
+            stats.idle_since = None
+            self._shown_idle.discard(worker_id)
+        elif report.when == "teardown":
+            stats.current = None
+            stats.completed += 1
+            stats.idle_since = time.monotonic()
+        if report.failed:
+            stats.failed += 1
+
+    @property
+    def width(self) -> int:
+        return len(self.workers)
+
+    def sorted_ids(self) -> List[str]:
+        # Sort gw2 before gw10
+        return sorted(self.workers, key=lambda worker_id: (len(worker_id), worker_id))
+
+    def idle_workers(self, now: float) -> List[Tuple[str, float]]:
+        """Returns the workers that have been idle for too long."""
+        idle = []
+        for worker_id, stats in self.workers.items():
+            if stats.idle_since is not None and not stats.down:
+                idle.append((stats.idle_since, worker_id))
+        idle.sort()
+        if self.starting:
+            idle = idle[: -len(self.starting)]
+        return [
+            (worker_id, now - since)
+            for since, worker_id in idle
+            if now - since >= self.idle_after
+        ]
+
+    def newly_idle_workers(self, now: float) -> List[Tuple[str, float]]:
+        """Returns the idle workers that have not been returned before."""
+        idle = []
+        for worker_id, elapsed in self.idle_workers(now):
+            if worker_id not in self._shown_idle:
+                self._shown_idle.add(worker_id)
+                idle.append((worker_id, elapsed))
+        return idle
+
+    def render(self, now: float) -> str:
+        """Returns one cell per worker showing its share of completed tests."""
+        most = max((stats.completed for stats in self.workers.values()), default=0)
+        idle = {worker_id for worker_id, _ in self.idle_workers(now)}
+        cells = []
+        for worker_id in self.sorted_ids():
+            stats = self.workers[worker_id]
+            if stats.down:
+                cells.append(colored("x", THEME.fail))
+            elif worker_id in idle:
+                cells.append(colored("·", THEME.warning))
+            else:
+                level = stats.completed * (len(self.blocks) - 1) // most if most else 0
+                cells.append(colored(self.blocks[max(level, 1)], THEME.progressbar))
+        return "".join(cells)
+
+
+def duplicate_terminal(file: TextIO) -> TextIO:
+    """Opens a duplicate of the file's descriptor, or returns the file itself.
+
+    pytest redirects the original descriptor to capture the output of running
+    tests, while the duplicate keeps writing to the terminal. What is written
+    to the duplicate of a counted file is counted too.
+    """
+    if isinstance(file, CountedFile):
+        duplicate = duplicate_terminal(file.file)
+        if duplicate is file.file:
+            return file
+        return CountedFile(duplicate, file.profile)
+    try:
+        fd = os.dup(file.fileno())
+    except (AttributeError, OSError, ValueError):
+        return file
+    return open(fd, "w", encoding=getattr(file, "encoding", None) or "utf-8")
+
+
+class AsyncTerminalWriter:
+    """File-like object that writes to another file from a background thread.
+
+    Writes are put on a bounded queue in order. When the queue is full,
+    regular writes wait for the writer thread to catch up, while progress
+    frames written with write_frame are dropped.
+
+    The thread writes to a duplicate of the file's descriptor, as pytest
+    redirects the original one to capture the output of running tests.
+    """
+
+    def __init__(self, file: TextIO, maxsize: int = 256) -> None:
+        self.file = file
+        self._out = duplicate_terminal(file)
+        self.dropped_frames = 0
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue(maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name="pytest-sugar-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, data: str) -> int:
+        self._queue.put(data)
+        return len(data)
+
+    def write_frame(self, data: str) -> bool:
+        """Queues a progress frame, returns False if it had to be dropped."""
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped_frames += 1
+            return False
+        return True
+
+    def flush(self) -> None:
+        # The writer thread flushes whenever it runs out of work
+        pass
+
+    def drain(self) -> None:
+        """Waits until everything queued so far has been written."""
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if self._out is not self.file:
+            self._out.close()
+
+    def isatty(self) -> bool:
+        return self.file.isatty()
+
+    def _run(self) -> None:
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                try:
+                    self._out.write(data)
+                except UnicodeEncodeError:
+                    self._out.write(data.encode("unicode-escape").decode("ascii"))
+                if self._queue.empty():
+                    self._out.flush()
+            except (OSError, ValueError):
+                # The terminal went away, keep draining so writers never block
+                pass
+            finally:
+                self._queue.task_done()
 
 
 class SugarTerminalReporter(TerminalReporter):
@@ -252,27 +1967,203 @@ class SugarTerminalReporter(TerminalReporter):
         self.paths_left = []
         self.tests_count = 0
         self.tests_taken = 0
-        self.reports = []
         self.unreported_errors = []
-        self.progress_blocks = []
+        self.progress_bar: Optional[ProgressBar] = None
+        # Number of reports per (category, when) that were added to self.stats
+        self.outcome_counts: Dict[Tuple[str, str], int] = {}
+        self.category_counts: Dict[str, int] = {}
+        self.frame_interval = 0.0
+        self._last_frame_time = 0.0
+        self._pending_frame: Optional[TestReport] = None
+        self._frame_timer: Optional[threading.Timer] = None
+        self._failed_in_frame = False
+        self.retain_full_reports = True
+        self.async_writer: Optional[AsyncTerminalWriter] = None
+        self.history: Optional[DurationHistory] = None
+        self.baseline: Optional[DurationBaseline] = None
+        self.regressed_letter = ""
+        self.show_eta = False
+        self.failed_first = False
+        self.shards: Optional[ShardDurations] = None
+        # Seconds from the start of the session to the first failure
+        self.first_failure_time: Optional[float] = None
+        self.watchdog: Optional[Watchdog] = None
+        self.thread_file: Optional[TextIO] = None
+        self.lanes: Optional[WorkerLanes] = None
+        self.resources: Optional[ResourceUsage] = None
+        self.collection: Optional[CollectionStats] = None
+        self.events: Optional[EventStream] = None
+        self.dedup_failures = False
+        self.artifact_index: Optional[ArtifactIndex] = None
+        # Results per directory when lines are aggregated by directory
+        self.directories: Optional[Dict[str, DirectoryStats]] = None
+        # Failures being formatted on a background thread, in order
+        self.failure_formatter: Optional["ThreadPoolExecutor"] = None
+        self._pending_failures: Deque[Tuple[TestReport, "Future[str]"]] = deque()
+        # Number of failures seen for each crash signature
+        self.failure_signatures: Dict[Tuple[Any, ...], int] = {}
+        # Append-only output for CI logs
+        self.ci_mode = False
+        self.ci_step = 10
+        self.ci_interval = 60.0
+        self._ci_next_percent = 0
+        self._ci_last_time = 0.0
+        # Held while writing, as the watchdog writes from its own thread
+        self.output_lock = threading.RLock()
+        # Visible widths of status letters, measured once per letter
+        self.letter_widths: Dict[str, int] = {}
         self.reset_tracked_lines()
+        self.profile: Optional[ReporterProfile] = None
+        if config.getoption("sugar_profile", False) or config.getoption(
+            "sugar_profile_json", None
+        ):
+            self.profile = ReporterProfile()
+            self.profile.instrument(self)
 
     def reset_tracked_lines(self) -> None:
-        self.current_lines = {}
-        self.current_line_nums = {}
+        self.status_lines: Dict[str, StatusLine] = {}
         self.current_line_num = 0
 
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_make_collect_report(self, collector) -> Generator:
+        collection = self.collection
+        if collection is None or not isinstance(collector, collection.timed):
+            yield
+            return
+        started = time.perf_counter()
+        yield
+        duration = time.perf_counter() - started
+        nodeid = collector.nodeid
+        if isinstance(collector, pytest.Package):
+            # Before pytest 8, packages are files named after their __init__.py
+            if nodeid.endswith("__init__.py"):
+                nodeid = nodeid.rpartition("/")[0]
+        elif isinstance(collector, pytest.File):
+            collection.files += 1
+            collection.durations[nodeid] = duration
+            return
+        collection.durations[(nodeid or ".") + "/"] = duration
+
     def pytest_collectreport(self, report: CollectReport) -> None:
         TerminalReporter.pytest_collectreport(self, report)
+        if self.collection is not None:
+            self.collection.record(report)
+            self.show_collection_progress(report.nodeid)
         if report.location[0]:
             self.paths_left.append(os.path.join(os.getcwd(), report.location[0]))
         if report.failed:
-            self.rewrite("")
+            if self.events is not None:
+                self.events.emit(
+                    "collect_error", nodeid=report.nodeid, path=report.fspath
+                )
+            self.flush_failures()
+            self.flush_progress()
+            if not self.ci_mode:
+                self.rewrite("")
             self.print_failure(report)
 
+    def report_collect(self, final: bool = False) -> None:
+        # The collection progress takes the place of pytest's own
+        if self.collection is None:
+            TerminalReporter.report_collect(self, final)
+        elif final:
+            if self.collection.last_frame:
+                # Leave the totals on screen
+                self.collection.last_frame = 0.0
+                self.show_collection_progress("")
+                self.write("\n")
+            TerminalReporter.report_collect(self, final)
+
+    def show_collection_progress(self, nodeid: str) -> None:
+        collection = self.collection
+        assert collection is not None
+        now = time.perf_counter()
+        if self.ci_mode or now - collection.last_frame < collection.frame_interval:
+            return
+        collection.last_frame = now
+        line = "collecting %d files, %d tests in %.1fs " % (
+            collection.files,
+            collection.items,
+            now - collection.started,
+        )
+        path = nodeid.split("::", 1)[0]
+        space = self._tw.fullwidth - len(line) - 1
+        if len(path) > space:
+            path = "..." + path[-(space - 3) :] if space > 3 else ""
+        self.rewrite(line + colored(path, THEME.path), erase=True)
+
     def pytest_sessionstart(self, session: Session) -> None:
         self._session = session
         self._sessionstarttime = time.time()
+        fps = float(get_setting(self.config, "fps", "0"))
+        self.frame_interval = 1.0 / fps if fps > 0 else 0.0
+        # Passed reports are needed in full to list them with -rp and to show
+        # their output with -rP
+        retention = get_setting(self.config, "retention", "full")
+        self.retain_full_reports = (
+            retention != "summary" or self.hasopt("p") or self.hasopt("P")
+        )
+        self.show_eta = get_flag(self.config, "eta")
+        self.failed_first = get_flag(self.config, "failed_first")
+        self.shards = self.config.pluginmanager.getplugin("sugar-shard")
+        if self.show_eta or self.failed_first:
+            self.history = DurationHistory(self.config)
+        self.dedup_failures = get_flag(self.config, "dedup")
+        baseline = DurationBaseline(
+            self.config,
+            factor=float(get_setting(self.config, "regression_factor", "2")),
+            min_seconds=float(get_setting(self.config, "regression_min", "0.05")),
+            save=bool(self.config.getoption("sugar_save_baseline", False)),
+        )
+        if baseline.baseline or baseline.save_current:
+            self.baseline = baseline
+            self.regressed_letter = STATUS_TABLE.color(
+                THEME.symbol_regressed, THEME.regressed
+            )
+        if self.config.getoption("sugar_resources", False):
+            self.resources = ResourceUsage()
+        if get_flag(self.config, "collection"):
+            self.collection = CollectionStats()
+        if get_flag(self.config, "directories") and not self.showlongtestinfo:
+            self.directories = {}
+        if get_flag(self.config, "tb_thread") and self.failure_formatter is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.failure_formatter = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="pytest-sugar-tb"
+            )
+        self.ci_mode = bool(self.config.getvalue("sugar_ci"))
+        self.ci_step = max(int(get_setting(self.config, "ci_step", "10")), 1)
+        self.ci_interval = float(get_setting(self.config, "ci_interval", "60"))
+        self._ci_next_percent = self.ci_step
+        self._ci_last_time = time.monotonic()
+        if (
+            get_flag(self.config, "workers")
+            and self.config.pluginmanager.getplugin("dsession") is not None
+        ):
+            self.lanes = WorkerLanes()
+        slow = float(get_setting(self.config, "slow", "0"))
+        stall = float(get_setting(self.config, "stall", "0"))
+        idle = self.lanes.idle_after if self.lanes is not None else 0.0
+        if (slow > 0 or stall > 0 or idle > 0) and self.watchdog is None:
+            slowest = int(get_setting(self.config, "slowest", "5")) if slow > 0 else 0
+            self.watchdog = Watchdog(self, slow, stall, slowest, idle)
+        if (self.watchdog is not None or self.frame_interval) and not self.thread_file:
+            # Output capturing is suspended between tests, so this is the terminal
+            file = duplicate_terminal(self._tw._file)
+            if file is not self._tw._file:
+                self.thread_file = file
+        events_path = get_setting(self.config, "events", "")
+        # Only the controller of a pytest-xdist run writes events
+        if (
+            events_path
+            and self.events is None
+            and not hasattr(self.config, "workerinput")
+        ):
+            self.events = EventStream(events_path)
+        if get_flag(self.config, "async_output") and self.async_writer is None:
+            self.async_writer = AsyncTerminalWriter(self._tw._file)
+            self._tw._file = self.async_writer
         if self.no_header:
             return
         verinfo = ".".join(map(str, sys.version_info[:3]))
@@ -301,88 +2192,261 @@ class SugarTerminalReporter(TerminalReporter):
     def write_fspath_result(self, nodeid: str, res, **markup: bool) -> None:
         return
 
-    def insert_progress(self, report: Union[CollectReport, TestReport]) -> None:
-        def get_progress_bar() -> str:
-            length = LEN_PROGRESS_BAR
-            if not length:
-                return ""
-
-            p = float(self.tests_taken) / self.tests_count if self.tests_count else 0
-            floored = int(p * length)
-            rem = int(round((p * length - floored) * (len(PROGRESS_BAR_BLOCKS) - 1)))
-            progressbar = "%i%% " % round(p * 100)
-            # make sure we only report 100% at the last test
-            if progressbar == "100% " and self.tests_taken < self.tests_count:
-                progressbar = "99% "
-
-            # if at least one block indicates failure,
-            # then the percentage should reflect that
-            if [1 for block, success in self.progress_blocks if not success]:
-                progressbar = colored(progressbar, THEME.fail)
-            else:
-                progressbar = colored(progressbar, THEME.success)
+    def insert_progress(
+        self, report: Union[CollectReport, TestReport], frame: bool = False
+    ) -> bool:
+        if self.progress_bar is None:
+            append_string = ""
+            append_width = 0
+        elif self.history is not None and self.show_eta:
+            append_string = self.progress_bar.render(
+                self.tests_taken, self.tests_count, self.history.fraction
+            )
+            time_left = self.history.time_left(time.time() - self._sessionstarttime)
+            eta = format_eta(time_left) if time_left is not None else ""
+            append_string = eta.rjust(LEN_ETA - 1) + " " + append_string
+            append_width = LEN_ETA + self.progress_bar.width
+        else:
+            append_string = self.progress_bar.render(self.tests_taken, self.tests_count)
+            append_width = self.progress_bar.width
+        if self.lanes is not None and self.lanes.width:
+            append_string = self.lanes.render(time.monotonic()) + " " + append_string
+            append_width += self.lanes.width + 1
 
-            bar = PROGRESS_BAR_BLOCKS[-1] * floored
-            if rem > 0:
-                bar += PROGRESS_BAR_BLOCKS[rem]
-            bar += " " * (LEN_PROGRESS_BAR - len(bar))
+        status_line = self.status_lines.get(self.report_key(report))
+        if status_line is None:
+            status_line = StatusLine(self.current_line_num, "", 0)
 
-            last = 0
-            last_theme = None
+        console_width = self._tw.fullwidth
+        num_spaces = console_width - status_line.width - append_width - LEN_RIGHT_MARGIN
+        full_line = status_line.text + " " * num_spaces
+        full_line += append_string
 
-            progressbar_background = THEME.progressbar_background
-            if progressbar_background is None:
-                on_color = None
-            else:
-                on_color = "on_" + progressbar_background
+        return self.overwrite(full_line, self.current_line_num - status_line.num, frame)
 
-            for block, success in self.progress_blocks:
-                if success:
-                    theme = THEME.progressbar
-                else:
-                    theme = THEME.progressbar_fail
+    def schedule_progress(self, report: TestReport, force: bool = False) -> None:
+        """Draws the progress for the report, at most once per frame interval.
 
-                if last < block:
-                    progressbar += colored(bar[last:block], last_theme, on_color)
+        Reports arriving within the same frame are coalesced and only the
+        latest one is drawn. A pending frame for another line is drawn first
+        so that no line is left with stale letters.
+        """
+        pending = self._pending_frame
+        if pending is not None and self.report_key(pending) != self.report_key(report):
+            self.flush_progress()
+        self._pending_frame = report
+        if force:
+            self.flush_progress()
+            return
+        wait = self.frame_interval - (time.monotonic() - self._last_frame_time)
+        if wait <= 0:
+            self.flush_progress(frame=True)
+        elif self._frame_timer is None:
+            # Draws the frame even if no other report comes in time, e.g. while
+            # the next test runs for long
+            self._frame_timer = threading.Timer(wait, self.draw_held_frame)
+            self._frame_timer.daemon = True
+            self._frame_timer.start()
+
+    def draw_held_frame(self) -> None:
+        """Draws the frame held back by the frame rate, from the frame timer."""
+        with self.thread_output():
+            if self._frame_timer is None:
+                return
+            self._frame_timer = None
+            self.flush_progress(frame=True)
 
-                progressbar += colored(bar[block], theme, on_color)
-                last = block + 1
-                last_theme = theme
+    def stop_frame_timer(self) -> None:
+        with self.output_lock:
+            timer = self._frame_timer
+            self._frame_timer = None
+        if timer is not None:
+            timer.cancel()
 
-            if last < len(bar):
-                progressbar += colored(bar[last : len(bar)], last_theme, on_color)
+    def flush_progress(self, frame: bool = False) -> None:
+        """Draws the pending progress frame, if any.
 
-            return progressbar
+        With frame set, the drawing is an intermediate frame that the
+        asynchronous writer may drop, in which case it stays pending.
+        """
+        report = self._pending_frame
+        if report is None:
+            return
+        self._pending_frame = None
+        self._last_frame_time = time.monotonic()
+        if not self.insert_progress(report, frame):
+            self._pending_frame = report
 
-        append_string = get_progress_bar()
+    def overwrite(self, line: str, rel_line_num: int, frame: bool = False) -> bool:
+        """Overwrites a line rel_line_num lines above the cursor.
 
-        path = self.report_key(report)
-        current_line = self.current_lines.get(path, "")
-        line_num = self.current_line_nums.get(path, self.current_line_num)
+        Returns False if the line was an intermediate frame that was dropped.
+        """
+        text = f"\r{line}"
+        if rel_line_num > 0:
+            # Move cursor up rel_line_num lines and back after overwriting
+            text = "\033[%dA%s\033[%dB" % (rel_line_num, text, rel_line_num)
+
+        if frame and self.async_writer is not None:
+            return self.async_writer.write_frame(text)
+        self.write(text)
+        return True
+
+    @contextlib.contextmanager
+    def thread_output(self) -> Generator[None, None, None]:
+        """Writes to the terminal from another thread while a test is running.
+
+        The running test's output is being captured, so the watchdog and the
+        frame timer write to a duplicate of the terminal's descriptor instead
+        of touching pytest's capturing from another thread. The asynchronous
+        writer already does.
+        """
+        with self.output_lock:
+            if self.thread_file is None or self.async_writer is not None:
+                yield
+                return
+            file = self._tw._file
+            self._tw.flush()
+            self._tw._file = self.thread_file
+            try:
+                yield
+            finally:
+                self._tw.flush()
+                self._tw._file = file
 
-        console_width = self._tw.fullwidth
-        num_spaces = (
-            console_width
-            - real_string_length(current_line)
-            - real_string_length(append_string)
-            - LEN_RIGHT_MARGIN
-        )
-        full_line = current_line + " " * num_spaces
-        full_line += append_string
+    def emit_test_event(
+        self, report: TestReport, category: str, letter: str, word: Any
+    ) -> None:
+        assert self.events is not None
+        data: Dict[str, Any] = {
+            "nodeid": report.nodeid,
+            "when": report.when,
+            "outcome": report.outcome,
+            "category": category,
+            "letter": strip_colors(letter),
+            "word": word[0] if isinstance(word, tuple) else word,
+            "duration": round(report.duration, 6),
+        }
+        node = getattr(report, "node", None)
+        if node is not None:
+            data["worker"] = node.gateway.id
+        if report.failed:
+            data["location"] = "%s:%s" % (
+                report.location[0],
+                self._get_lineno_from_report(report) or "?",
+            )
+            artifacts = self._find_playwright_artifacts(report)
+            if artifacts is not None:
+                if artifacts.trace is not None:
+                    data["trace"] = self._relative_path(artifacts.trace)
+                if artifacts.screenshots:
+                    data["screenshots"] = [
+                        self._relative_path(path) for path in artifacts.screenshots
+                    ]
+                if artifacts.videos:
+                    data["videos"] = [
+                        self._relative_path(path) for path in artifacts.videos
+                    ]
+        self.events.emit("test", **data)
+
+    def show_ci_progress(self) -> None:
+        """Writes a progress line every few percent or seconds of the run."""
+        now = time.monotonic()
+        if self.tests_count:
+            percent = 100 * self.tests_taken // self.tests_count
+        else:
+            percent = 100
+        if (
+            self.tests_taken < self.tests_count
+            and percent < self._ci_next_percent
+            and now - self._ci_last_time < self.ci_interval
+        ):
+            return
+        self._ci_next_percent = (percent // self.ci_step + 1) * self.ci_step
+        self._ci_last_time = now
+        self.flush_failures()
+
+        line = " [%3d%%] %d/%d tests" % (percent, self.tests_taken, self.tests_count)
+        when = ("setup", "call", "teardown")
+        failed = self.count("failed", when=when)
+        if failed:
+            line += ", " + colored("%d failed" % failed, THEME.fail)
+        skipped = self.count("skipped", when=when)
+        if skipped:
+            line += ", " + colored("%d skipped" % skipped, THEME.skipped)
+        elapsed = time.time() - self._sessionstarttime
+        line += " in " + format_session_duration(elapsed)
+        if self.history is not None and self.show_eta:
+            time_left = self.history.time_left(elapsed)
+            if time_left is not None and self.tests_taken < self.tests_count:
+                line += ", %s left" % format_eta(time_left)
+        self.write_line(line)
+
+    def write_notice(self, text: str) -> None:
+        """Writes text on a line of its own below the progress lines."""
+        self.flush_failures()
+        if self.ci_mode:
+            self.write_line(text)
+            return
+        self.flush_progress()
+        self.write("\r\n" + text)
+        self.current_line_num += 1
 
-        self.overwrite(full_line, self.current_line_num - line_num)
+    def show_slow_test(self, nodeid: str, elapsed: float) -> None:
+        """Shows a test that is still running on a line of its own."""
+        with self.thread_output():
+            self.write_notice(
+                " %s %s still running after %.0fs"
+                % (colored("⏳", THEME.warning), nodeid, elapsed)
+            )
 
-    def overwrite(self, line: str, rel_line_num: int) -> None:
-        # Move cursor up rel_line_num lines
-        if rel_line_num > 0:
-            self.write("\033[%dA" % rel_line_num)
+    def show_slowest_tests(self, slowest: List[Tuple[float, str]]) -> None:
+        """Shows the slowest tests finished so far on a line of its own."""
+        with self.thread_output():
+            self.write_notice(
+                " %s slowest so far: %s"
+                % (
+                    colored("⏱", THEME.warning),
+                    ", ".join(
+                        "%s %.2fs" % (nodeid, duration) for duration, nodeid in slowest
+                    ),
+                )
+            )
 
-        # Overwrite the line
-        self.write(f"\r{line}")
+    def show_idle_workers(self) -> None:
+        """Shows workers that have had no test to run for a while."""
+        assert self.lanes is not None
+        with self.thread_output():
+            tests_left = self.tests_count - self.tests_taken
+            if tests_left <= 0:
+                return
+            for worker_id, elapsed in self.lanes.newly_idle_workers(time.monotonic()):
+                self.write_notice(
+                    " %s %s idle for %.1fs, %d tests not finished yet"
+                    % (colored("⚠", THEME.warning), worker_id, elapsed, tests_left)
+                )
 
-        # Return cursor to original line
-        if rel_line_num > 0:
-            self.write("\033[%dB" % rel_line_num)
+    def show_stalled_test(self, nodeid: str, elapsed: float) -> None:
+        """Shows the stacks of all threads for a test that seems stuck."""
+        with self.thread_output():
+            self.flush_failures()
+            self.flush_progress()
+            self.write_line("")
+            self.write_sep("!", "%s stalled for %.0fs" % (nodeid, elapsed))
+            if self.config.pluginmanager.getplugin("dsession") is not None:
+                self.write_line("Stacks are not available for tests run by xdist")
+            else:
+                for line in format_thread_stacks():
+                    self.write_line(line)
+            self.reset_tracked_lines()
+
+    def stop_async_output(self) -> None:
+        """Writes out everything queued and goes back to synchronous output."""
+        if self.async_writer is None:
+            return
+        self.async_writer.close()
+        self._tw._file = self.async_writer.file
+        self.async_writer = None
 
     def get_max_column_for_test_status(self) -> int:
         assert LEN_PROGRESS_BAR
@@ -391,12 +2455,16 @@ class SugarTerminalReporter(TerminalReporter):
             self._tw.fullwidth
             - LEN_PROGRESS_PERCENTAGE
             - LEN_PROGRESS_BAR
+            - (LEN_ETA if self.show_eta else 0)
+            - (self.lanes.width + 1 if self.lanes is not None else 0)
             - LEN_RIGHT_MARGIN
         )
 
     def begin_new_line(
         self, report: Union[CollectReport, TestReport], print_filename: bool
     ) -> None:
+        # The last letters of the previous line must be drawn before moving on
+        self.flush_progress()
         path = self.report_key(report)
         self.current_line_num += 1
         if len(report.fspath) > self.get_max_column_for_test_status() - 5:
@@ -420,47 +2488,166 @@ class SugarTerminalReporter(TerminalReporter):
                 # test_name contains the filename
                 # FIXME: This doesn't work.
                 # test_name = test_name.replace('.', '::')
-            self.current_lines[path] = (
+            separator = "::" if self.verbosity > 0 else ""
+            self.status_lines[path] = StatusLine(
+                self.current_line_num,
                 " "
                 + colored(test_location, THEME.path)
-                + ("::" if self.verbosity > 0 else "")
+                + separator
                 + colored(test_name, THEME.name)
-                + " "
+                + " ",
+                display_width(" " + test_location + separator + test_name + " "),
             )
         else:
-            self.current_lines[path] = " " * (2 + len(fspath))
-        self.current_line_nums[path] = self.current_line_num
+            self.status_lines[path] = StatusLine(
+                self.current_line_num, " " * (2 + len(fspath)), 2 + len(fspath)
+            )
         self.write("\r\n")
 
+    def count_directory_tests(self, nodeids: Iterable[str]) -> None:
+        assert self.directories is not None
+        for stats in self.directories.values():
+            stats.total = 0
+        for nodeid in nodeids:
+            directory = directory_of(nodeid)
+            stats = self.directories.get(directory)
+            if stats is None:
+                stats = self.directories[directory] = DirectoryStats()
+            stats.total += 1
+
+    def update_directory_line(self, report: TestReport, letter: str) -> None:
+        """Counts the result in the line of the test's directory.
+
+        A test is counted as done on its teardown report, so tests that
+        error in setup are counted too, and its letter is counted like in
+        the regular status lines.
+        """
+        assert self.directories is not None
+        shows_letter = bool(letter) and (report.when == "call" or report.skipped)
+        if not (report.when == "teardown" or report.failed or shows_letter):
+            return
+        directory = directory_of(report.nodeid)
+        stats = self.directories.get(directory)
+        if stats is None:
+            stats = self.directories[directory] = DirectoryStats()
+        if report.when == "teardown":
+            stats.done += 1
+        stats.failed = stats.failed or report.failed
+        if shows_letter:
+            stats.letters[letter] = stats.letters.get(letter, 0) + 1
+
+        status_line = self.status_lines.get(directory)
+        if status_line is None:
+            self.flush_progress()
+            self.current_line_num += 1
+            status_line = StatusLine(self.current_line_num, "", 0)
+            self.status_lines[directory] = status_line
+            self.write("\r\n")
+
+        name = (directory or ".") + "/"
+        max_length = self.get_max_column_for_test_status() // 2
+        if len(name) > max_length:
+            name = "..." + name[-(max_length - 3) :]
+        bar_length = 10
+        filled = min(stats.done * bar_length // stats.total, 10) if stats.total else 0
+        bar = colored(
+            "█" * filled, THEME.progressbar_fail if stats.failed else THEME.progressbar
+        ) + "·" * (bar_length - filled)
+        counts = " ".join(
+            "%s %d" % (letter, count) for letter, count in stats.letters.items()
+        )
+        if stats.total:
+            done = "%5d/%-5d" % (stats.done, stats.total)
+        else:
+            done = "%5d" % stats.done
+        name_text = colored(name, THEME.path)
+        status_line.text = " %s %s %s %s" % (name_text, bar, done, counts)
+        # Measured without the colors, which would take a regex pass per test
+        status_line.width = (
+            display_width(name)
+            + bar_length
+            + len(done)
+            + 4
+            + sum(
+                self.letter_width(letter) + 2 + len(str(count))
+                for letter, count in stats.letters.items()
+            )
+            - (1 if stats.letters else 0)
+        )
+
+    def letter_width(self, letter: str) -> int:
+        """Returns the visible width of a status letter."""
+        try:
+            return self.letter_widths[letter]
+        except KeyError:
+            width = self.letter_widths[letter] = display_width(strip_colors(letter))
+            return width
+
     def reached_last_column_for_test_status(
         self, report: Union[CollectReport, TestReport]
     ) -> bool:
-        len_line = real_string_length(self.current_lines[self.report_key(report)])
+        len_line = self.status_lines[self.report_key(report)].width
         return len_line >= self.get_max_column_for_test_status()
 
     def pytest_runtest_logstart(self, nodeid, location) -> None:
         # Prevent locationline from being printed since we already
         # show the module_name & in verbose mode the test name.
-        pass
+        if self.async_writer is not None and self.config.option.capture == "no":
+            # Uncaptured test output goes straight to the terminal and must
+            # not overtake the output that is still queued
+            self.async_writer.drain()
+        if self.watchdog is not None:
+            self.watchdog.start_test(nodeid)
+        if self.lanes is not None:
+            self.lanes.start_test(nodeid)
 
     def pytest_runtest_logfinish(self, nodeid: str) -> None:
         # prevent the default implementation to try to show
         # pytest's default progress
-        pass
+        if self.watchdog is not None:
+            self.watchdog.finish_test(nodeid)
 
     def report_key(self, report: Union[CollectReport, TestReport]) -> Any:
         """Returns a key to identify which line the report should write to."""
+        if self.directories is not None:
+            return directory_of(report.nodeid)
         return (
             (report.location or "") if self.showlongtestinfo else (report.fspath or "")
         )
 
     def pytest_runtest_logreport(self, report: TestReport) -> None:
+        with self.output_lock:
+            self.show_report(report)
+
+    def show_report(self, report: TestReport) -> None:
         global LEN_PROGRESS_BAR_SETTING, LEN_PROGRESS_BAR
 
         res = pytest_report_teststatus(report=report)
         assert res
         cat, letter, word = res
-        self.stats.setdefault(cat, []).append(report)
+        if self.baseline is not None:
+            self.baseline.record(report)
+            # A slower fixture shows up on the letter of the test using it
+            if (
+                report.when == "call"
+                and report.passed
+                and self.baseline.is_regressed(report.nodeid, ("setup", "call"))
+            ):
+                letter = self.regressed_letter
+        if self.retain_full_reports or cat != "passed":
+            self.stats.setdefault(cat, []).append(report)
+        else:
+            records = self.stats.get(cat)
+            if records is None:
+                records = self.stats[cat] = ReportRecords()
+            records.append(report)
+        key = (cat, report.when)
+        self.outcome_counts[key] = self.outcome_counts.get(key, 0) + 1
+        self.category_counts[cat] = self.category_counts.get(cat, 0) + 1
+        if self.events is not None and (
+            report.when == "call" or report.failed or report.skipped
+        ):
+            self.emit_test_event(report, cat, letter, word)
 
         if not LEN_PROGRESS_BAR:
             if LEN_PROGRESS_BAR_SETTING.endswith("%"):
@@ -469,44 +2656,91 @@ class SugarTerminalReporter(TerminalReporter):
                 )
             else:
                 LEN_PROGRESS_BAR = int(LEN_PROGRESS_BAR_SETTING)
+        if self.progress_bar is None:
+            self.progress_bar = ProgressBar(LEN_PROGRESS_BAR)
 
-        self.reports.append(report)
         if report.outcome == "failed":
-            print("")
-            self.print_failure(report)
+            self._failed_in_frame = True
+            if self.failed_first and self.first_failure_time is None:
+                self.first_failure_time = time.time() - self._sessionstarttime
+            if self.is_repeated_failure(report):
+                pass
+            elif self.failure_formatter is not None:
+                self.defer_failure(report)
+            else:
+                self.flush_progress()
+                self._tw.line()
+                self.print_failure(report)
+            if not self.retain_full_reports and self.failure_formatter is None:
+                # The captured output has been shown already
+                report.sections = []
             # Ignore other reports or it will cause duplicated letters
+        if self.history is not None:
+            self.history.record(report)
+        if self.lanes is not None:
+            self.lanes.record(report)
+        if self._pending_failures and (
+            report.when == "call"
+            or report.skipped
+            or (self.directories is not None and report.when == "teardown")
+        ):
+            # Failures of earlier tests are written before the next letter or
+            # count, so they are formatted while the tests in between run
+            self.flush_failures(until=report.nodeid)
+        if self.directories is not None and not self.ci_mode:
+            # Before the teardown draws the line
+            self.update_directory_line(report, letter)
+        if self.resources is not None and report.when == "teardown":
+            usage = getattr(report, "sugar_resources", None)
+            if usage is not None:
+                self.resources.record(report.nodeid, *usage)
         if report.when == "teardown":
             self.tests_taken += 1
-            self.insert_progress(report)
+            if self.ci_mode:
+                self.show_ci_progress()
+            else:
+                # Always draw the last test and tests that failed right away
+                self.schedule_progress(
+                    report,
+                    force=self.tests_taken >= self.tests_count or self._failed_in_frame,
+                )
+            self._failed_in_frame = False
             path = os.path.join(os.getcwd(), report.location[0])
 
-        if report.when == "call" or report.skipped:
+        if self.ci_mode:
+            if self.verbosity > 0 and (report.when == "call" or report.skipped):
+                if isinstance(word, tuple):
+                    word = word[0]
+                if word:
+                    self.write_line(f"{word} {report.nodeid}")
+            return
+
+        if self.directories is not None and (report.when == "call" or report.skipped):
+            block = int(
+                float(self.tests_taken) * LEN_PROGRESS_BAR / self.tests_count
+                if self.tests_count
+                else 0
+            )
+            self.progress_bar.mark(block, success=not report.failed)
+        elif report.when == "call" or report.skipped:
             path = self.report_key(report)
-            if path not in self.current_line_nums:
+            if path not in self.status_lines:
                 self.begin_new_line(report, print_filename=True)
             elif self.reached_last_column_for_test_status(report):
                 # Print filename if another line was inserted in-between
-                print_filename = (
-                    self.current_line_nums[self.report_key(report)]
-                    != self.current_line_num
-                )
+                print_filename = self.status_lines[path].num != self.current_line_num
                 self.begin_new_line(report, print_filename)
 
-            self.current_lines[path] = self.current_lines[path] + letter
+            status_line = self.status_lines[path]
+            status_line.text += letter
+            status_line.width += self.letter_width(letter)
 
             block = int(
                 float(self.tests_taken) * LEN_PROGRESS_BAR / self.tests_count
                 if self.tests_count
                 else 0
             )
-            if report.failed:
-                if not self.progress_blocks or self.progress_blocks[-1][0] != block:
-                    self.progress_blocks.append([block, False])
-                elif self.progress_blocks and self.progress_blocks[-1][0] == block:
-                    self.progress_blocks[-1][1] = False
-            else:
-                if not self.progress_blocks or self.progress_blocks[-1][0] != block:
-                    self.progress_blocks.append([block, True])
+            self.progress_bar.mark(block, success=not report.failed)
 
             if not letter and not word:
                 return
@@ -531,86 +2765,278 @@ class SugarTerminalReporter(TerminalReporter):
                     self._tw.write(" " + line)
                     self.currentfspath = -2
 
+    def is_repeated_failure(self, report: TestReport) -> bool:
+        """Returns whether the failure crashed like an earlier one.
+
+        Only used with failure deduplication; counts the failure as well.
+        """
+        if not self.dedup_failures:
+            return False
+        signature = crash_signature(report)
+        if signature is None:
+            return False
+        seen = self.failure_signatures.get(signature, 0)
+        self.failure_signatures[signature] = seen + 1
+        return seen > 0
+
+    def failure_groups(self, when: tuple) -> List[Tuple[TestReport, int]]:
+        """Returns the first of each group of failures and the number of repeats.
+
+        Without failure deduplication, every failure is a group of its own.
+        """
+        groups: Dict[Any, List[Any]] = {}
+        for report in self.stats.get("failed", []):
+            if getattr(report, "when", None) not in when:
+                continue
+            key = crash_signature(report) if self.dedup_failures else None
+            if key is None:
+                key = id(report)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [report, 0]
+            else:
+                group[1] += 1
+        return [(report, repeats) for report, repeats in groups.values()]
+
+    def format_failure_line(self, report: TestReport, repeats: int) -> str:
+        if self.config.option.tb_summary:
+            crashline = self._get_decoded_crashline(report)
+        else:
+            path = os.path.dirname(report.location[0])
+            name = os.path.basename(report.location[0])
+            lineno = self._get_lineno_from_report(report)
+            crashline = "{}{}{}:{} {}".format(
+                colored(path, THEME.path),
+                "/" if path else "",
+                colored(name, THEME.name),
+                lineno if lineno else "?",
+                colored(report.location[2], THEME.fail),
+            )
+        if repeats:
+            crashline += " (and %d more with the same error)" % repeats
+
+        # Add trace.zip path if it exists, and the other files Playwright left
+        # for the test
+        artifacts = self._find_playwright_artifacts(report)
+        if artifacts is not None:
+            if artifacts.trace is not None:
+                trace_path = self._show_trace_command(
+                    self._relative_path(artifacts.trace)
+                )
+                crashline += f"\n           - 🎭 {trace_path}"
+            for screenshot in artifacts.screenshots:
+                crashline += "\n           - 📷 %s" % self._relative_path(screenshot)
+            for video in artifacts.videos:
+                crashline += "\n           - 🎬 %s" % self._relative_path(video)
+        return f"         - {crashline}"
+
     def count(self, key: str, when: tuple = ("call",)) -> int:
         value = self.stats.get(key)
-        if value:
-            return len([x for x in value if not hasattr(x, "when") or x.when in when])
-        return 0
+        if not value:
+            return 0
+        if len(value) == self.category_counts.get(key, 0):
+            return sum(self.outcome_counts.get((key, w), 0) for w in when)
+        # Some entries were added by pytest itself (e.g. deselected items)
+        # or another plugin, so the running counters are not enough.
+        return len([x for x in value if not hasattr(x, "when") or x.when in when])
+
+    def outcome_totals(self) -> Dict[str, int]:
+        """Returns the number of tests for each outcome shown in the summary."""
+        return {
+            "passed": self.count("passed"),
+            "xpassed": self.count("xpassed"),
+            "failed": self.count("failed", when=("call",)),
+            "error": self.count("failed", when=("setup", "teardown")),
+            "xfailed": self.count("xfailed"),
+            "skipped": self.count("skipped", when=("call", "setup", "teardown")),
+            "rerun": self.count("rerun"),
+            "deselected": self.count("deselected"),
+        }
 
     def summary_stats(self) -> None:
         session_duration = time.time() - self._sessionstarttime
-        print(f"\nResults ({format_session_duration(session_duration)}):")
-
-        if self.count("passed") > 0:
+        self._tw.line(f"\nResults ({format_session_duration(session_duration)}):")
+
+        totals = self.outcome_totals()
+        passed = totals["passed"]
+        if passed > 0:
+            self.write_line(colored("   % 5d passed" % passed, THEME.success))
+
+        xpassed = totals["xpassed"]
+        if xpassed > 0:
+            self.write_line(colored("   % 5d xpassed" % xpassed, THEME.xpassed))
+
+        failed = totals["failed"]
+        if failed > 0:
+            self.write_line(colored("   % 5d failed" % failed, THEME.fail))
+            for report, repeats in self.failure_groups(when=("call",)):
+                self.write_line(self.format_failure_line(report, repeats))
+
+        errors = totals["error"]
+        if errors > 0:
+            self.write_line(colored("   % 5d error" % errors, THEME.error))
+            if self.dedup_failures:
+                for report, repeats in self.failure_groups(when=("setup", "teardown")):
+                    self.write_line(self.format_failure_line(report, repeats))
+
+        xfailed = totals["xfailed"]
+        if xfailed > 0:
+            self.write_line(colored("   % 5d xfailed" % xfailed, THEME.xfailed))
+
+        skipped = totals["skipped"]
+        if skipped > 0:
+            self.write_line(colored("   % 5d skipped" % skipped, THEME.skipped))
+
+        rerun = totals["rerun"]
+        if rerun > 0:
+            self.write_line(colored("   % 5d rerun" % rerun, THEME.rerun))
+
+        deselected = totals["deselected"]
+        if deselected > 0:
+            self.write_line(colored("   % 5d deselected" % deselected, THEME.warning))
+
+        if self.failed_first and self.first_failure_time is not None:
+            self.write_line("")
             self.write_line(
-                colored("   % 5d passed" % self.count("passed"), THEME.success)
+                "First failure after %s"
+                % format_session_duration(self.first_failure_time)
             )
 
-        if self.count("xpassed") > 0:
-            self.write_line(
-                colored("   % 5d xpassed" % self.count("xpassed"), THEME.xpassed)
-            )
+        shards = self.shards
+        if shards is not None and shards.shard is not None:
+            line = "Shard %d/%d: " % shards.shard
+            if shards.predicted is not None:
+                line += "%.2fs of tests predicted, " % shards.predicted
+            self.write_line("")
+            self.write_line(line + "%.2fs taken" % sum(shards.current.values()))
+
+        if self.watchdog is not None and self.watchdog.slowest:
+            self.write_line("")
+            self.write_line("Slowest tests:")
+            for duration, nodeid in sorted(self.watchdog.slowest, reverse=True):
+                self.write_line(
+                    "   %7.2fs %s" % (duration, colored(nodeid, THEME.path))
+                )
 
-        if self.count("failed", when=("call",)) > 0:
-            self.write_line(
-                colored(
-                    "   % 5d failed" % self.count("failed", when=("call",)),
-                    THEME.fail,
+        if self.baseline is not None and self.baseline.regressions:
+            self.write_line("")
+            self.write_line("Slower than the baseline:")
+            for nodeid, when, expected, duration in self.baseline.biggest(5):
+                self.write_line(
+                    "   %7.2fs -> %7.2fs %-8s %s"
+                    % (expected, duration, when, colored(nodeid, THEME.path))
                 )
-            )
-            for i, report in enumerate(self.stats["failed"]):
-                if report.when != "call":
-                    continue
 
-                if self.config.option.tb_summary:
-                    crashline = self._get_decoded_crashline(report)
-                else:
-                    path = os.path.dirname(report.location[0])
-                    name = os.path.basename(report.location[0])
-                    lineno = self._get_lineno_from_report(report)
-                    crashline = "{}{}{}:{} {}".format(
-                        colored(path, THEME.path),
-                        "/" if path else "",
-                        colored(name, THEME.name),
-                        lineno if lineno else "?",
-                        colored(report.location[2], THEME.fail),
-                    )
-
-                # Add trace.zip path if it exists
-                trace_path = self._find_playwright_trace(report)
-                if trace_path:
-                    crashline += f"\n           - 🎭 {trace_path}"
-                self.write_line(f"         - {crashline}")
-
-        if self.count("failed", when=("setup", "teardown")) > 0:
+        if self.resources is not None and self.resources.files:
+            self.summary_resources()
+
+        if self.collection is not None and self.collection.durations:
+            self.summary_collection()
+
+        if self.lanes is not None and self.lanes.workers:
+            self.summary_workers(session_duration)
+
+        if self.async_writer is not None:
+            self.async_writer.drain()
+
+    def summary_collection(self) -> None:
+        collection = self.collection
+        assert collection is not None
+        self.write_line("")
+        self.write_line(
+            "Slowest to collect (%.2fs for %d files):"
+            % (sum(collection.durations.values()), collection.files)
+        )
+        for nodeid, duration in collection.slowest(5):
+            items = collection.item_counts.get(nodeid)
             self.write_line(
-                colored(
-                    "   % 5d error"
-                    % (self.count("failed", when=("setup", "teardown"))),
-                    THEME.error,
+                "   %7.2fs %11s  %s"
+                % (
+                    duration,
+                    "%d tests" % items if items is not None else "",
+                    colored(nodeid, THEME.path),
                 )
             )
 
-        if self.count("xfailed") > 0:
+    def summary_resources(self) -> None:
+        resources = self.resources
+        assert resources is not None
+        self.write_line("")
+        self.write_line("Resources (peak RSS %.1f MB):" % (resources.peak / 1e6))
+        self.write_line("   Most memory:")
+        for rss, nodeid in sorted(resources.memory, reverse=True):
+            self.write_line(
+                "   %+9.1f MB  %s" % (rss / 1e6, colored(nodeid, THEME.path))
+            )
+        self.write_line("   Most CPU time:")
+        for cpu, wall, nodeid in sorted(resources.cpu, reverse=True):
+            self.write_line(
+                "   %7.2fs cpu %7.2fs wall  %s"
+                % (cpu, wall, colored(nodeid, THEME.path))
+            )
+        self.write_line("   Files:")
+        for path, (cpu, wall, rss) in resources.top_files():
             self.write_line(
-                colored("   % 5d xfailed" % self.count("xfailed"), THEME.xfailed)
+                "   %+9.1f MB %7.2fs cpu %7.2fs wall  %s"
+                % (rss / 1e6, cpu, wall, colored(path, THEME.path))
             )
 
-        if self.count("skipped", when=("call", "setup", "teardown")) > 0:
+    def summary_workers(self, session_duration: float) -> None:
+        lanes = self.lanes
+        assert lanes is not None
+        workers = lanes.workers
+        busy = [stats.busy for stats in workers.values()]
+        mean_busy = sum(busy) / len(busy)
+        most = max(stats.completed for stats in workers.values())
+        self.write_line("")
+        self.write_line(
+            "Workers (load imbalance %.2f):"
+            % (max(busy) / mean_busy if mean_busy else 1.0)
+        )
+        for worker_id in lanes.sorted_ids():
+            stats = workers[worker_id]
+            bar_length = 10 * stats.completed // most if most else 0
+            bar = colored("█" * bar_length, THEME.progressbar)
             self.write_line(
-                colored(
-                    "   % 5d skipped"
-                    % (self.count("skipped", when=("call", "setup", "teardown"))),
-                    THEME.skipped,
+                "   %s %s %5d tests %7.1f tests/s  busy %3d%%%s"
+                % (
+                    colored(worker_id.ljust(5), THEME.path),
+                    bar + " " * (10 - bar_length),
+                    stats.completed,
+                    stats.completed / session_duration if session_duration else 0.0,
+                    100 * stats.busy / session_duration if session_duration else 0,
+                    colored("  down", THEME.fail) if stats.down else "",
                 )
             )
 
-        if self.count("rerun") > 0:
-            self.write_line(colored("   % 5d rerun" % self.count("rerun"), THEME.rerun))
-
-        if self.count("deselected") > 0:
+    def summary_profile(self) -> None:
+        profile = self.profile
+        assert profile is not None
+        session_duration = time.time() - self._sessionstarttime
+        path = self.config.getoption("sugar_profile_json", None)
+        if path:
+            data = profile.as_dict()
+            data["session_duration"] = session_duration
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+        if not self.config.getoption("sugar_profile", False):
+            return
+        share = 100 * profile.total / session_duration if session_duration else 0.0
+        self.write_line("")
+        self.write_line(
+            "pytest-sugar took %.3fs (%.1f%% of the session) and wrote %d bytes:"
+            % (profile.total, share, profile.bytes_written)
+        )
+        self.write_line("      calls    self (ms)   total (ms)  method")
+        for name in sorted(profile.methods, key=profile.self_times.__getitem__)[::-1]:
             self.write_line(
-                colored("   % 5d deselected" % self.count("deselected"), THEME.warning)
+                "   %8d %12.3f %12.3f  %s"
+                % (
+                    profile.calls[name],
+                    profile.self_times[name] * 1000,
+                    profile.total_times[name] * 1000,
+                    name,
+                )
             )
 
     def _find_playwright_trace(self, report: TestReport) -> Optional[str]:
@@ -634,55 +3060,46 @@ class SugarTerminalReporter(TerminalReporter):
         or
         None if trace is not enabled, the file does not exist, or an exception occurs.
         """
-        # Check if trace finding is disabled
-        if self.config.option.sugar_no_trace:
+        trace_file = self._find_playwright_trace_file(report)
+        if trace_file is None:
             return None
+        return self._show_trace_command(trace_file)
 
-        try:
-            # Extract test information from the report
-            nodeid = report.nodeid
-
-            # Handle Node ID conversion to trace name format
-            trace_dir_name = self._convert_node_to_trace_name(nodeid)
-
-            # Construct the expected trace directory path
-            cwd = os.getcwd()
-            trace_dir_name_from_config = self.config.option.sugar_trace_dir
-            test_results_dir = os.path.join(cwd, trace_dir_name_from_config)
-            trace_dir = os.path.join(test_results_dir, trace_dir_name)
-            trace_file = os.path.join(trace_dir, "trace.zip")
-
-            # Check if the trace file exists
-            if os.path.exists(trace_file):
-                # Provide the relative path and a command to view the trace
-                trace_file_relative = os.path.relpath(trace_file, cwd).replace(
-                    "\\", "/"
-                )
-
-                # Create a command to open the trace with Playwright for Python
-                view_command = f"playwright show-trace {trace_file_relative}"
-
-                # Display unzip command
-                command_display = colored(view_command, THEME.warning)
-                return command_display
+    @staticmethod
+    def _show_trace_command(trace_file: str) -> str:
+        # Create a command to open the trace with Playwright for Python
+        view_command = f"playwright show-trace {trace_file}"
+        return colored(view_command, THEME.warning)
+
+    def _find_playwright_trace_file(self, report: TestReport) -> Optional[str]:
+        """Returns the path of the test's Playwright trace, relative to cwd."""
+        artifacts = self._find_playwright_artifacts(report)
+        if artifacts is None or artifacts.trace is None:
             return None
+        return self._relative_path(artifacts.trace)
 
-        except (OSError, AttributeError):
+    def _find_playwright_artifacts(
+        self, report: TestReport
+    ) -> Optional[PlaywrightArtifacts]:
+        """Looks up the files Playwright left for the test in the trace dir."""
+        # Check if trace finding is disabled
+        if self.config.option.sugar_no_trace:
             return None
+        if self.artifact_index is None:
+            # Scanned lazily, on the first failure that needs it
+            self.artifact_index = ArtifactIndex(
+                os.path.join(os.getcwd(), self.config.option.sugar_trace_dir)
+            )
+        return self.artifact_index.get(self._convert_node_to_trace_name(report.nodeid))
+
+    @staticmethod
+    def _relative_path(path: str) -> str:
+        return os.path.relpath(path, os.getcwd()).replace("\\", "/")
 
     @staticmethod
     def _convert_node_to_trace_name(nodeid: str) -> str:
         # Convert the nodeid to the expected trace directory name
-        trace_dir_name = (
-            nodeid.replace("/", "-")
-            .replace("\\", "-")
-            .replace("::", "-")
-            .replace("[", "-")
-            .replace("]", "")
-            .replace("_", "-")
-            .replace(".", "-")
-        )
-        return trace_dir_name.lower()
+        return nodeid.replace("::", "-").translate(TRACE_NAME_TABLE).lower()
 
     def _get_decoded_crashline(self, report: CollectReport) -> str:
         crashline = self._getcrashline(report)
@@ -731,20 +3148,90 @@ class SugarTerminalReporter(TerminalReporter):
             return
 
         if self.config.option.tbstyle != "no":
-            if self.config.option.tbstyle == "line":
-                line = self._getcrashline(report)
-                self.write_line(line)
-            else:
-                msg = self._getfailureheadline(report)
-                # "when" was unset before pytest 4.2 for collection errors.
-                when = getattr(report, "when", "collect")
-                if when == "collect":
-                    msg = "ERROR collecting " + msg
-                elif when == "setup":
-                    msg = "ERROR at setup of " + msg
-                elif when == "teardown":
-                    msg = "ERROR at teardown of " + msg
-                self.write_line("")
-                self.write_sep("―", msg)
-                self._outrep_summary(report)
+            self.ensure_newline()
+            self.write_failure(report, self._tw)
         self.reset_tracked_lines()
+
+    def write_failure(
+        self, report: Union[CollectReport, TestReport], tw: TerminalWriter
+    ) -> None:
+        """Writes the traceback of a failure to tw.
+
+        Does not change the reporter, so that it can run on another thread.
+        """
+        if self.config.option.tbstyle == "line":
+            line = self._getcrashline(report)
+            tw.line(line)
+            return
+        msg = self._getfailureheadline(report)
+        # "when" was unset before pytest 4.2 for collection errors.
+        when = getattr(report, "when", "collect")
+        if when == "collect":
+            msg = "ERROR collecting " + msg
+        elif when == "setup":
+            msg = "ERROR at setup of " + msg
+        elif when == "teardown":
+            msg = "ERROR at teardown of " + msg
+        tw.line("")
+        tw.sep("―", msg)
+        report.toterminal(tw)
+        showcapture = self.config.option.showcapture
+        if showcapture == "no":
+            return
+        for secname, content in report.sections:
+            if showcapture != "all" and showcapture not in secname:
+                continue
+            tw.sep("-", secname)
+            if content[-1:] == "\n":
+                content = content[:-1]
+            tw.line(content)
+
+    def defer_failure(self, report: TestReport) -> None:
+        """Formats the failure on the background thread.
+
+        The output is written by flush_failures, before the status letter of
+        another test and before any other output apart from the status line
+        of the failed test itself.
+        """
+        assert self.failure_formatter is not None
+        if hasattr(report, "wasxfail") or self.config.option.tbstyle == "no":
+            return
+        buffer = io.StringIO()
+        tw = TerminalWriter(buffer)
+        tw.hasmarkup = self._tw.hasmarkup
+        tw.fullwidth = self._tw.fullwidth
+        tw.code_highlight = getattr(self._tw, "code_highlight", True)
+
+        def format_failure() -> str:
+            self.write_failure(report, tw)
+            return buffer.getvalue()
+
+        future = self.failure_formatter.submit(format_failure)
+        self._pending_failures.append((report, future))
+
+    def flush_failures(self, until: Optional[str] = None) -> None:
+        """Writes the failures formatted on the background thread, in order.
+
+        With until set, stops at the first failure of the test with that nodeid.
+        """
+        while self._pending_failures:
+            report, future = self._pending_failures[0]
+            if report.nodeid == until:
+                break
+            self._pending_failures.popleft()
+            text = future.result()
+            self.flush_progress()
+            self._tw.line()
+            self.ensure_newline()
+            self._tw.write(text)
+            self.reset_tracked_lines()
+            if not self.retain_full_reports:
+                # The captured output has been shown already
+                report.sections = []
+
+    def stop_failure_formatter(self) -> None:
+        if self.failure_formatter is None:
+            return
+        self.flush_failures()
+        self.failure_formatter.shutdown()
+        self.failure_formatter = None
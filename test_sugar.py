@@ -1,9 +1,31 @@
 import io
+import json
 import re
+import subprocess
+import sys
+import time
 
 import pytest
-
-from pytest_sugar import SugarTerminalReporter, strip_colors
+from _pytest.reports import TestReport
+
+import pytest_sugar
+from pytest_sugar import (
+    ArtifactIndex,
+    AsyncTerminalWriter,
+    DurationBaseline,
+    DurationHistory,
+    ProgressBar,
+    ReportRecords,
+    ShardDurations,
+    StatusTable,
+    SugarTerminalReporter,
+    Theme,
+    WorkerLanes,
+    directory_of,
+    display_width,
+    format_eta,
+    strip_colors,
+)
 
 pytest_plugins = "pytester"
 
@@ -52,6 +74,518 @@ def assert_count(testdir, *args):
     )
 
 
+def test_display_width():
+    assert display_width("test_foo.py ") == 12
+    assert display_width("✓⨯ₓ") == 3
+    assert display_width("🎭✅") == 4
+    assert display_width("e\u0301") == 1
+
+
+def test_directory_of():
+    assert directory_of("tests/unit/test_a.py::TestA::test_b[x/y]") == "tests/unit"
+    assert directory_of("test_a.py::test_b") == ""
+
+
+def test_format_eta():
+    assert format_eta(0.4) == "~0s"
+    assert format_eta(59) == "~59s"
+    assert format_eta(125) == "~2m05s"
+    assert format_eta(3 * 3600 + 120) == "~3h02m"
+
+
+def test_status_table():
+    table = StatusTable(Theme(), markup=False)
+    table.fill()
+    location = ("test_a.py", 0, "test_a")
+    report = TestReport("test_a.py::test_a", location, {}, "failed", None, "setup")
+    assert table.lookup(report) == ("failed", "ₓ", "FAILED")
+    report.when = "call"
+    assert table.lookup(report) == ("failed", "⨯", "FAILED")
+    report.outcome = "skipped"
+    report.wasxfail = ""
+    assert table.lookup(report) == ("xfailed", "x", "xfail")
+    # Outcomes added by other plugins are resolved on first use
+    report.outcome = "flaky"
+    assert table.lookup(report) == ("flaky", "?", "FLAKY")
+    assert ("flaky", "call", True) in table.statuses
+
+
+def test_import_time():
+    # Everything pytest-sugar imports on its own, as reported by -X importtime
+    code = "import pytest, _pytest.pytester, _pytest.terminal; import pytest_sugar"
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stderr
+    *imports, last = output.splitlines()
+    assert last.endswith("| pytest_sugar")
+    modules = []
+    for line in reversed(imports):
+        name = line.split("|")[2]
+        if not name.startswith("  "):
+            break
+        modules.append(name.strip())
+    assert not {"termcolor", "configparser", "concurrent.futures"} & set(modules)
+
+
+class TestDurationHistory:
+    def make_report(self, nodeid, when, duration):
+        return TestReport(
+            nodeid, ("t.py", 0, nodeid), {}, "passed", None, when, (), duration
+        )
+
+    def test_weighted_progress_and_time_left(self, pytestconfig, monkeypatch):
+        history = DurationHistory(pytestconfig)
+        monkeypatch.setattr(history, "_cache", None)
+        history.durations = {"slow": 9.0, "fast": 1.0}
+        history.start(["slow", "fast", "new"])
+        assert history.expected_total == 15.0
+        assert history.fraction == 0
+        assert history.time_left(0.0) is None
+
+        for when in ("setup", "call", "teardown"):
+            history.record(self.make_report("slow", when, 1.0))
+        assert history.fraction == 9.0 / 15.0
+        # The run goes twice as fast as before
+        assert history.time_left(4.5) == 3.0
+        assert history.current == {"slow": 3.0}
+
+    def test_save(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_one():
+                pass
+            """
+        )
+        testdir.runpytest("--force-sugar", "--sugar-eta")
+        config = testdir.parseconfigure()
+        durations = config.cache.get(DurationHistory.cache_key, None)
+        assert list(durations) == ["test_save.py::test_one"]
+
+        result = testdir.runpytest("--force-sugar", "--sugar-eta")
+        result.stdout.fnmatch_lines(["*test_save.py ✓*~0s 100%*"])
+
+    def test_order(self, pytestconfig, monkeypatch):
+        class Item:
+            def __init__(self, nodeid):
+                self.nodeid = nodeid
+
+        history = DurationHistory(pytestconfig)
+        history.durations = {"a.py::1": 5.0, "a.py::2": 5.0, "b.py::1": 1.0}
+        history.failed = {"c.py::2"}
+        items = [Item(nodeid) for nodeid in ("a.py::1", "a.py::2", "b.py::1")]
+        items += [Item("c.py::1"), Item("c.py::2"), Item("d.py::1")]
+        ordered = [item.nodeid for item in history.order(items)]
+        assert ordered == [
+            "c.py::1",
+            "c.py::2",
+            "b.py::1",
+            "d.py::1",
+            "a.py::1",
+            "a.py::2",
+        ]
+
+    def test_failed_first(self, testdir, monkeypatch):
+        testdir.makepyfile(
+            test_slow="import time\ndef test_slow(): time.sleep(0.1)\n",
+            test_fast="def test_fast(): pass\n",
+            test_flaky="import os\ndef test_flaky(): assert os.environ['FLAKY']\n",
+        )
+        monkeypatch.setenv("FLAKY", "")
+        result = testdir.runpytest("--force-sugar", "--sugar-failed-first", "-v")
+        result.stdout.fnmatch_lines(["First failure after *s"])
+        config = testdir.parseconfigure()
+        assert config.cache.get(DurationHistory.failed_cache_key, None) == [
+            "test_flaky.py::test_flaky"
+        ]
+
+        monkeypatch.setenv("FLAKY", "1")
+        result = testdir.runpytest("--force-sugar", "--sugar-failed-first", "-v")
+        result.stdout.fnmatch_lines(
+            ["*test_flaky.py::test_flaky*", "*test_fast.py::test_fast*", "*test_slow*"]
+        )
+        assert "First failure" not in result.stdout.str()
+        config = testdir.parseconfigure()
+        assert config.cache.get(DurationHistory.failed_cache_key, None) == []
+
+
+class TestShardDurations:
+    def test_shard(self):
+        class Item:
+            def __init__(self, nodeid):
+                self.nodeid = nodeid
+
+        items = [Item(nodeid) for nodeid in "abcde"]
+        shards = ShardDurations((1, 2), None)
+        shards.durations = {"a": 5.0, "b": 4.0, "c": 3.0, "d": 3.0, "e": 1.0}
+        first, rest = shards.split(items)
+        assert [item.nodeid for item in first] == ["a", "d"]
+        assert shards.predicted == 8.0
+        shards.shard = (2, 2)
+        second, _ = shards.split(items)
+        assert [item.nodeid for item in second] == ["b", "c", "e"]
+        assert sorted(rest, key=items.index) == second
+        # Without durations, every test counts the same
+        shards.durations = {}
+        first, _ = shards.split(items)
+        assert [item.nodeid for item in first] == ["b", "d"]
+        assert shards.predicted is None
+
+    def test_shard_option(self, testdir, monkeypatch):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("i", range(10))
+            def test_nada(i):
+                pass
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-shard=2/2")
+        result.stdout.fnmatch_lines(
+            ["*5 passed*", "*5 deselected*", "Shard 2/2: *s taken"]
+        )
+        assert "predicted" not in result.stdout.str()
+        result = testdir.runpytest("--force-sugar", "--sugar-shard=3/2")
+        assert result.ret == pytest.ExitCode.USAGE_ERROR
+
+        # Shards are also run, and durations saved, without pytest-sugar's output
+        monkeypatch.setattr("pytest_sugar.IS_SUGAR_ENABLED", False)
+        durations = {
+            "test_shard_option.py::test_nada[%d]" % i: i + 1 for i in range(10)
+        }
+        testdir.tmpdir.join("durations.json").write(json.dumps(durations))
+        ran = []
+        saved = {}
+        for index in (1, 2):
+            # Each job updates its own copy of the shared file
+            path = "durations_%d.json" % index
+            testdir.tmpdir.join("durations.json").copy(testdir.tmpdir.join(path))
+            result = testdir.runpytest(
+                "-v", "--sugar-shard=%d/2" % index, "--sugar-shard-durations=" + path
+            )
+            result.stdout.fnmatch_lines(["*5 passed, 5 deselected*"])
+            ran.append(set(re.findall(r"test_nada\[\d\] PASSED", result.stdout.str())))
+            saved.update(json.loads(testdir.tmpdir.join(path).read()))
+            assert len(saved) == 5 * index
+        assert len(ran[0]) == len(ran[1]) == 5
+        assert not ran[0] & ran[1]
+        # Together the files of the jobs have new durations for every test
+        assert sorted(saved) == sorted(durations)
+        assert all(saved[nodeid] < 1 for nodeid in saved)
+        result = testdir.runpytest(
+            "--force-sugar",
+            "--sugar-shard=1/2",
+            "--sugar-shard-durations=durations.json",
+        )
+        result.stdout.fnmatch_lines(["Shard 1/2: 28.00s of tests predicted, *s taken"])
+
+    def test_shard_xdist(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("i", range(10))
+            def test_nada(i):
+                pass
+            """
+        )
+        durations = {"test_shard_xdist.py::test_nada[%d]" % i: 1 for i in range(10)}
+        testdir.tmpdir.join("durations.json").write(json.dumps(durations))
+        result = testdir.runpytest(
+            "-n2", "--sugar-shard=1/2", "--sugar-shard-durations=durations.json"
+        )
+        result.stdout.fnmatch_lines(["*5 passed*"])
+        saved = json.loads(testdir.tmpdir.join("durations.json").read())
+        # Only the tests of the shard, as the other shard saves its own
+        assert len(saved) == 5
+        assert all(duration < 1 for duration in saved.values())
+
+
+class TestDurationBaseline:
+    def make_report(self, nodeid, when, duration):
+        return TestReport(
+            nodeid, ("t.py", 0, nodeid), {}, "passed", None, when, (), duration
+        )
+
+    def test_regressions(self, pytestconfig):
+        baseline = DurationBaseline(pytestconfig, 2.0, 0.05, save=False)
+        baseline.baseline = {"a": [0.01, 1.0, 0.0], "b": [0.0, 0.001, 0.0]}
+        for nodeid, when, duration in (
+            ("a", "setup", 0.5),
+            ("a", "call", 1.5),
+            ("b", "call", 0.01),
+            ("c", "call", 9.0),
+        ):
+            baseline.record(self.make_report(nodeid, when, duration))
+
+        # b is 10 times slower but within the noise, c has no baseline
+        assert baseline.biggest(5) == [("a", "setup", 0.01, 0.5)]
+        assert baseline.is_regressed("a", ("setup", "call"))
+        assert not baseline.is_regressed("a", ("call",))
+        assert baseline.current == {}
+
+    def test_save_and_compare(self, testdir, monkeypatch):
+        testdir.makepyfile(
+            """
+            import os, time, pytest
+
+            @pytest.fixture
+            def fixture():
+                time.sleep(float(os.environ.get("DELAY", "0")))
+
+            def test_fixture(fixture):
+                pass
+
+            def test_same():
+                pass
+            """
+        )
+        testdir.runpytest("--force-sugar", "--sugar-save-baseline")
+        config = testdir.parseconfigure()
+        baseline = config.cache.get(DurationBaseline.cache_key, None)
+        assert sorted(baseline) == [
+            "test_save_and_compare.py::test_fixture",
+            "test_save_and_compare.py::test_same",
+        ]
+
+        monkeypatch.setenv("DELAY", "0.2")
+        result = testdir.runpytest("--force-sugar")
+        result.stdout.fnmatch_lines(
+            [
+                "* test_save_and_compare.py ↓✓ *",
+                "Slower than the baseline:",
+                "*s ->    0.2?s setup    test_save_and_compare.py::test_fixture",
+            ]
+        )
+        # The baseline is only changed when asked to
+        config = testdir.parseconfigure()
+        assert config.cache.get(DurationBaseline.cache_key, None) == baseline
+
+
+class TestProgressBar:
+    def test_render(self):
+        bar = ProgressBar(10)
+        bar.mark(0, success=True)
+        assert strip_colors(bar.render(1, 4)) == "25% ██▌       "
+        bar.mark(2, success=True)
+        assert strip_colors(bar.render(2, 4)) == "50% █████     "
+        assert strip_colors(bar.render(4, 4)) == "100% ██████████"
+
+    def test_only_last_test_is_100_percent(self):
+        bar = ProgressBar(10)
+        assert strip_colors(bar.render(999, 1000)) == "99% ██████████"
+
+    def test_failure_colors_rest_of_bar(self):
+        bar = ProgressBar(4)
+        bar.mark(0, success=True)
+        passing = bar.render(1, 4)
+        assert not bar.has_failed
+        bar.mark(1, success=False)
+        failing = bar.render(2, 4)
+        assert bar.has_failed
+        assert strip_colors(failing) == "50% ██  "
+        assert failing != passing
+
+    def test_failure_sticks_to_block(self):
+        bar = ProgressBar(2)
+        bar.mark(0, success=False)
+        first = bar.render(1, 4)
+        bar.mark(0, success=True)
+        assert bar.render(1, 4) == first
+
+    def test_width(self):
+        bar = ProgressBar(10)
+        bar.render(1, 3)
+        assert bar.width == len("33% ") + 10
+        bar.render(3, 3)
+        assert bar.width == len("100% ") + 10
+
+    def test_render_fraction(self):
+        bar = ProgressBar(10)
+        assert strip_colors(bar.render(1, 4, fraction=0.9)) == "90% █████████ "
+        assert strip_colors(bar.render(4, 4, fraction=0.9)) == "100% ██████████"
+
+    def test_no_length(self):
+        bar = ProgressBar(0)
+        bar.mark(0, success=False)
+        assert bar.render(1, 2) == ""
+
+
+class TestAsyncTerminalWriter:
+    def test_drops_frames_but_not_writes(self):
+        class SlowFile(io.StringIO):
+            def write(self, s):
+                time.sleep(0.001)
+                return super().write(s)
+
+        file_obj = SlowFile()
+        writer = AsyncTerminalWriter(file_obj, maxsize=2)
+        for i in range(50):
+            writer.write_frame("f")
+            writer.write("%d," % i)
+        writer.close()
+
+        assert writer.dropped_frames > 0
+        written = file_obj.getvalue().replace("f", "")
+        assert written == "".join("%d," % i for i in range(50))
+
+    def test_drain(self):
+        file_obj = io.StringIO()
+        writer = AsyncTerminalWriter(file_obj)
+        writer.write("hello")
+        writer.drain()
+        assert file_obj.getvalue() == "hello"
+        writer.close()
+
+
+class TestReportRecords:
+    def test_records(self):
+        records = ReportRecords()
+        for nodeid in ("test_a.py::test_a", "test_a.py::test_b"):
+            location = ("test_a.py", 0, nodeid.split("::")[1])
+            for when in ("setup", "call", "teardown"):
+                records.append(
+                    TestReport(nodeid, location, {}, "passed", None, when, [], 0.5)
+                )
+
+        assert len(records) == 6
+        assert len(records._nodeids) == 2
+        report = records[4]
+        assert (report.nodeid, report.when, report.outcome, report.duration) == (
+            "test_a.py::test_b",
+            "call",
+            "passed",
+            0.5,
+        )
+        assert report.passed and report.head_line == "test_b"
+        assert records[-1].when == "teardown"
+        assert [r.when for r in records[:2]] == ["setup", "call"]
+        assert sum(r.when == "call" for r in records) == 2
+        with pytest.raises(IndexError):
+            records[6]
+
+
+class TestArtifactIndex:
+    def test_lookup_and_refresh(self, tmpdir):
+        index = ArtifactIndex(str(tmpdir.join("test-results")))
+        assert index.get("test-a") is None
+
+        test_a = tmpdir.join("test-results", "test-a").ensure(dir=True)
+        assert index.get("test-a").trace is None
+        test_a.join("trace.zip").write("")
+        test_a.join("test-failed-1.png").write("")
+        test_a.join("video.webm").write("")
+        artifacts = index.get("test-a")
+        assert artifacts.trace == str(test_a.join("trace.zip"))
+        assert artifacts.screenshots == [str(test_a.join("test-failed-1.png"))]
+        assert artifacts.videos == [str(test_a.join("video.webm"))]
+
+        tmpdir.join("test-results", "test-b", "trace.zip").ensure()
+        assert index.get("test-b").trace is not None
+        # Hits do not touch the filesystem
+        test_a.remove()
+        assert index.get("test-a") is artifacts
+
+    def test_miss_scans_only_the_test(self, tmpdir, monkeypatch):
+        results = tmpdir.join("test-results")
+        for i in range(10):
+            results.join("test-%d" % i, "trace.zip").ensure()
+        index = ArtifactIndex(str(results))
+        assert index.get("test-0").trace is not None
+
+        scanned = []
+        scan_entry = index.scan_entry
+
+        def counted_scan_entry(name, path):
+            scanned.append(name)
+            scan_entry(name, path)
+
+        monkeypatch.setattr(index, "scan_entry", counted_scan_entry)
+        results.join("test-new", "trace.zip").ensure()
+        assert index.get("test-new").trace is not None
+        assert index.get("test-missing") is None
+        assert index.get("test-5").trace is not None
+        assert scanned == ["test-new", "test-missing"]
+        # Misses are remembered until a directory is added
+        assert index.get("test-missing") is None
+        assert scanned == ["test-new", "test-missing"]
+        results.join("test-missing", "trace.zip").ensure()
+        assert index.get("test-missing").trace is not None
+
+    def test_missing_directory(self, tmpdir, monkeypatch):
+        results = tmpdir.join("test-results")
+        index = ArtifactIndex(str(results))
+        scandir = pytest_sugar.os.scandir
+        scanned = []
+
+        def counted_scandir(path):
+            scanned.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr(pytest_sugar.os, "scandir", counted_scandir)
+        for _ in range(3):
+            assert index.get("test-a") is None
+        assert scanned == []
+        results.join("test-a", "trace.zip").ensure()
+        assert index.get("test-a").trace is not None
+
+    def test_trace_name(self):
+        convert = SugarTerminalReporter._convert_node_to_trace_name
+        assert (
+            convert("tests/test_ui.py::TestLogin::test_ok[chromium]")
+            == "tests-test-ui-py-testlogin-test-ok-chromium"
+        )
+
+
+class TestWorkerLanes:
+    def make_report(self, worker_id, nodeid, when):
+        report = TestReport(
+            nodeid, ("t.py", 0, nodeid), {}, "passed", None, when, (), 0.5
+        )
+        report.node = type("Node", (), {"gateway": type("Gw", (), {"id": worker_id})})
+        return report
+
+    def run_test(self, lanes, worker_id, nodeid):
+        lanes.start_test(nodeid)
+        for when in ("setup", "call", "teardown"):
+            lanes.record(self.make_report(worker_id, nodeid, when))
+
+    def test_record(self):
+        lanes = WorkerLanes()
+        for worker_id in ("gw0", "gw1", "gw10", "gw2"):
+            lanes.ready(worker_id)
+        self.run_test(lanes, "gw0", "t.py::a")
+        self.run_test(lanes, "gw0", "t.py::b")
+        lanes.record(self.make_report("gw1", "t.py::c", "setup"))
+
+        assert lanes.sorted_ids() == ["gw0", "gw1", "gw2", "gw10"]
+        assert lanes.workers["gw0"].completed == 2
+        assert lanes.workers["gw0"].busy == 3.0
+        assert lanes.workers["gw1"].current == "t.py::c"
+        assert strip_colors(lanes.render(time.monotonic())) == "█▁▁▁"
+
+    def test_idle_workers(self):
+        lanes = WorkerLanes(idle_after=10)
+        for worker_id in ("gw0", "gw1", "gw2"):
+            lanes.ready(worker_id)
+        lanes.record(self.make_report("gw0", "t.py::a", "setup"))
+        now = time.monotonic() + 20
+        assert [w for w, _ in lanes.idle_workers(now)] == ["gw1", "gw2"]
+        assert strip_colors(lanes.render(now)) == "▁··"
+
+        # A test started on an unknown worker, assume it is the last idle one
+        lanes.start_test("t.py::b")
+        assert [w for w, _ in lanes.newly_idle_workers(now)] == ["gw1"]
+        assert lanes.newly_idle_workers(now) == []
+
+        lanes.down("gw1")
+        assert strip_colors(lanes.render(now)) == "▁x▁"
+
+
 class TestTerminalReporter:
     def test_sugar_terminal_reporter_init_signature(self, pytestconfig):
         terminal_reporter = pytestconfig.pluginmanager.getplugin("terminalreporter")
@@ -63,6 +597,62 @@ class TestTerminalReporter:
         assert sugar_reporter.config is terminal_reporter.config
         assert sugar_reporter._tw._file is file_obj
 
+    def test_count_uses_running_counters(self, pytestconfig, monkeypatch):
+        monkeypatch.setattr("pytest_sugar.IS_SUGAR_ENABLED", True)
+        sugar_reporter = SugarTerminalReporter(pytestconfig, file=io.StringIO())
+        sugar_reporter.tests_count = 2
+        for name, outcome in (("test_a", "passed"), ("test_b", "failed")):
+            for when in ("setup", "call", "teardown"):
+                report = TestReport(
+                    "t.py::" + name,
+                    ("t.py", 0, name),
+                    {},
+                    outcome if when == "call" else "passed",
+                    None,
+                    when,
+                )
+                sugar_reporter.pytest_runtest_logreport(report)
+
+        assert sugar_reporter.count("passed") == 1
+        assert sugar_reporter.count("passed", when=("setup", "teardown")) == 4
+        assert sugar_reporter.count("failed") == 1
+        assert sugar_reporter.count("skipped") == 0
+
+        # Entries added behind the reporter's back are still counted
+        sugar_reporter.stats.setdefault("passed", []).append(object())
+        assert sugar_reporter.count("passed") == 2
+
+    def test_summary_retention(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            def test_pass():
+                print("captured output")
+
+            def test_fail():
+                print("captured output")
+                assert False
+
+            @pytest.mark.skip
+            def test_skip():
+                pass
+            """
+        )
+        full = strip_colors(testdir.runpytest("--force-sugar").stdout.str())
+        summary = strip_colors(
+            testdir.runpytest("--force-sugar", "--sugar-retention=summary").stdout.str()
+        )
+        assert full.split("):")[-1] == summary.split("):")[-1]
+        assert "captured output" in summary
+
+        result = testdir.runpytest("--force-sugar", "--sugar-retention=summary", "-rP")
+        result.stdout.fnmatch_lines(["*PASSES*", "*captured output*"])
+
+        result = testdir.runpytest("--force-sugar", "--sugar-retention=summary", "-rp")
+        result.stdout.fnmatch_lines(["PASSED *test_pass*"])
+        assert "INTERNALERROR" not in result.stdout.str()
+
     def test_new_summary(self, testdir):
         testdir.makepyfile(
             """
@@ -285,6 +875,215 @@ class TestTerminalReporter:
         )
         assert result.ret == 0
 
+    def test_fps_limit_draws_final_frame(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("i", range(20))
+            def test_many(i):
+                pass
+            """
+        )
+        limited = testdir.runpytest("--force-sugar", "--sugar-fps=0.001")
+        unlimited = testdir.runpytest("--force-sugar")
+        limited_output = strip_colors(limited.stdout.str())
+        assert "100%" in limited_output
+        assert "✓" * 20 in limited_output
+        assert limited_output.count("%") <= 2
+        assert strip_colors(unlimited.stdout.str()).count("%") == 20
+
+    def test_fps_limit_draws_held_frame(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            import pytest
+
+            @pytest.mark.parametrize("i", range(5))
+            def test_fast(i):
+                pass
+
+            def test_slow():
+                time.sleep(1)
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-fps=4")
+        # The frame of the fast tests is drawn while the slow test runs
+        assert re.search("(?<!✓)✓{5}(?!✓)", strip_colors(result.stdout.str()))
+
+    def test_no_color(self, testdir, monkeypatch):
+        testdir.makepyfile("def test_pass(): pass")
+        testdir.runpytest("--force-sugar")
+        assert pytest_sugar.STATUS_TABLE.markup
+
+        result = testdir.runpytest("--force-sugar", "--color=no")
+        statuses = pytest_sugar.STATUS_TABLE.statuses
+        assert statuses["passed", "call", False] == ("passed", "✓", "PASSED")
+        result.stdout.fnmatch_lines(["* test_no_color.py ✓*"])
+
+        monkeypatch.setenv("NO_COLOR", "1")
+        testdir.runpytest("--force-sugar")
+        assert not pytest_sugar.STATUS_TABLE.markup
+
+    def test_config_not_read_when_disabled(self, testdir, monkeypatch):
+        monkeypatch.setattr("pytest_sugar.IS_SUGAR_ENABLED", False)
+        testdir.makefile(".conf", **{"pytest-sugar": "not an ini file"})
+        testdir.makepyfile("def test_pass(): pass")
+
+        assert testdir.runpytest().ret == 0
+        result = testdir.runpytest("--force-sugar")
+        assert result.ret == pytest.ExitCode.INTERNAL_ERROR
+
+    def test_fps_limit_draws_failures_immediately(self, testdir):
+        testdir.makeini(
+            """
+            [pytest]
+            addopts = --force-sugar
+            """
+        )
+        testdir.makefile(".conf", **{"pytest-sugar": "[sugar]\nfps = 0.001\n"})
+        testdir.makepyfile(
+            """
+            def test_pass():
+                pass
+
+            def test_fail():
+                assert False
+
+            def test_pass_again():
+                pass
+            """
+        )
+        output = strip_colors(testdir.runpytest().stdout.str())
+        before_traceback = output.split("test_fail", 1)[0]
+        assert "✓" in before_traceback
+        assert "⨯" in output.split("def test_fail():", 1)[1]
+
+    def test_fps_limit_draws_wrapped_lines(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("i", range(150))
+            def test_many(i):
+                pass
+            """
+        )
+        output = testdir.runpytest("--force-sugar", "--sugar-fps=0.001").stdout.str()
+        counts = [
+            line.count("✓") for line in strip_colors(output).splitlines() if "✓" in line
+        ]
+        # Every full line is drawn once it is complete, the last one at the end
+        full_line = max(counts)
+        assert counts.count(full_line) == 150 // full_line
+        assert counts[-1] == 150 % full_line
+
+    def test_async_output(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_pass():
+                pass
+
+            def test_fail():
+                assert False
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-async-output")
+        result.stdout.fnmatch_lines(
+            [
+                "*test_async_output.py ✓*",
+                "*def test_fail():*",
+                "E       assert False",
+                "Results*",
+                "*1 passed*",
+                "*1 failed*",
+            ]
+        )
+
+    def test_slow_tests(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_fast():
+                pass
+
+            def test_slow():
+                time.sleep(0.5)
+            """
+        )
+        result = testdir.runpytest(
+            "--force-sugar", "--sugar-slow=0.2", "--sugar-slowest=1"
+        )
+        result.stdout.fnmatch_lines(
+            [
+                "*test_slow_tests.py::test_slow still running after 0s*",
+                "Slowest tests:",
+                "*s test_slow_tests.py::test_slow",
+            ]
+        )
+        assert "s test_slow_tests.py::test_fast" not in result.stdout.str()
+
+    def test_slowest_so_far(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_first():
+                time.sleep(0.4)
+
+            def test_second():
+                time.sleep(0.4)
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-slow=0.2")
+        result.stdout.fnmatch_lines(
+            [
+                "*test_slowest_so_far.py::test_first still running after 0s*",
+                "*test_slowest_so_far.py::test_second still running after 0s*",
+                "*slowest so far: test_slowest_so_far.py::test_first 0.*s*",
+            ]
+        )
+
+    def test_slow_tests_captured(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_slow():
+                for _ in range(10):
+                    print("captured output")
+                    time.sleep(0.05)
+            """
+        )
+        result = testdir.runpytest_subprocess("--force-sugar", "--sugar-slow=0.2")
+        result.stdout.fnmatch_lines(
+            ["*test_slow_tests_captured.py::test_slow still running after 0s*"]
+        )
+        assert "captured output" not in result.stdout.str()
+        assert result.ret == 0
+
+    def test_stalled_test(self, testdir):
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_stuck():
+                time.sleep(0.5)
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-stall=0.2")
+        result.stdout.fnmatch_lines(
+            [
+                "*test_stalled_test.py::test_stuck stalled for 0s*",
+                "Thread MainThread:",
+                "*in test_stuck",
+                "*time.sleep(0.5)",
+            ]
+        )
+        assert "Slowest tests:" not in result.stdout.str()
+
     def test_fail(self, testdir):
         testdir.makepyfile(
             """
@@ -537,6 +1336,403 @@ class TestTerminalReporter:
 
         assert result.ret == 0, result.stderr.str()
 
+    def test_ci_mode(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("i", range(40))
+            def test_a(i):
+                assert i != 17
+            """
+        )
+        result = testdir.runpytest("--sugar-ci", "--sugar-ci-step=25")
+        output = result.stdout.str()
+
+        assert "\x1b[" not in output
+        assert "\r" not in output
+        result.stdout.fnmatch_lines(
+            [
+                "*25%] 10/40 tests in *",
+                "*def test_a(i):",
+                "*50%] 20/40 tests, 1 failed in *",
+                "*75%] 30/40 tests, 1 failed in *",
+                "*100%] 40/40 tests, 1 failed in *",
+                "Results (*):",
+                "*39 passed",
+            ]
+        )
+        assert output.count("/40 tests") == 4
+
+    def test_ci_mode_verbose(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_a():
+                pass
+            """
+        )
+        result = testdir.runpytest("--sugar-ci", "-v")
+        result.stdout.fnmatch_lines(
+            ["PASSED test_ci_mode_verbose.py::test_a", "*100%] 1/1 tests in *"]
+        )
+
+    def test_resources(self, testdir):
+        testdir.makepyfile(
+            """
+            data = []
+
+            def test_memory():
+                data.append(bytearray(20_000_000))
+
+            def test_nothing():
+                pass
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-resources")
+        result.stdout.fnmatch_lines(
+            [
+                "Resources (peak RSS * MB):",
+                "   Most memory:",
+                "*+2?.? MB  test_resources.py::test_memory",
+                "*test_resources.py::test_nothing",
+                "   Most CPU time:",
+                "*s cpu *s wall  test_resources.py::test_*",
+                "   Files:",
+                "*+2?.? MB *s cpu *s wall  test_resources.py",
+            ]
+        )
+
+    def test_collection(self, testdir):
+        testdir.mkpydir("sub")
+        testdir.makepyfile(
+            **{
+                "sub/conftest.py": "import time; time.sleep(0.1)",
+                "sub/test_slow.py": """
+                    import time
+
+                    time.sleep(0.1)
+
+                    def test_a():
+                        pass
+
+                    def test_b():
+                        pass
+                """,
+                "test_fast.py": "def test_c(): pass",
+            }
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-collection")
+        result.stdout.fnmatch_lines(
+            [
+                "collecting 2 files, 3 tests in *",
+                "collected 3 items",
+            ]
+        )
+        # The order of the files and directories depends on the version of pytest
+        for line in (
+            "Slowest to collect (*s for 2 files):",
+            "      0.1?s     2 tests  sub/test_slow.py",
+            "      0.0?s     1 tests  test_fast.py",
+            "      ?.??s              sub/",
+        ):
+            result.stdout.fnmatch_lines([line])
+        assert "__init__.py" not in result.stdout.str()
+        assert result.ret == 0
+
+    def test_profile(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_a():
+                pass
+
+            def test_b():
+                assert False
+            """
+        )
+        result = testdir.runpytest(
+            "--force-sugar", "--sugar-profile", "--sugar-profile-json=profile.json"
+        )
+        result.stdout.fnmatch_lines(
+            [
+                "pytest-sugar took *s (*% of the session) and wrote * bytes:",
+                "*calls    self (ms)   total (ms)  method",
+                "*       6 * pytest_runtest_logreport",
+            ]
+        )
+        profile = json.loads(testdir.tmpdir.join("profile.json").read())
+        assert profile["methods"]["pytest_runtest_logreport"]["calls"] == 6
+        assert profile["methods"]["print_failure"]["calls"] == 1
+        assert profile["methods"]["summary_stats"]["calls"] == 1
+        assert profile["bytes_written"] > 0
+        logreport = profile["methods"]["pytest_runtest_logreport"]
+        assert logreport["self"] <= logreport["total"]
+
+    def test_profile_async_output(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_a():
+                pass
+            """
+        )
+        result = testdir.runpytest_subprocess(
+            "--force-sugar",
+            "--sugar-profile",
+            "--sugar-profile-json=profile.json",
+            "--sugar-async-output",
+        )
+        assert result.ret == 0
+        profile = json.loads(testdir.tmpdir.join("profile.json").read())
+        assert profile["bytes_written"] > len("test_profile_async_output.py")
+
+    def test_events(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            def test_a():
+                pass
+
+            def test_b():
+                assert False
+
+            @pytest.mark.skip
+            def test_c():
+                pass
+            """
+        )
+        testdir.runpytest("--force-sugar", "--sugar-events=events.ndjson")
+        lines = testdir.tmpdir.join("events.ndjson").read().splitlines()
+        events = [json.loads(line) for line in lines]
+
+        assert [event["event"] for event in events] == [
+            "collection",
+            "test",
+            "test",
+            "test",
+            "session_finish",
+        ]
+        assert events[0]["tests_count"] == 3
+        passed, failed, skipped = events[1:4]
+        assert passed["nodeid"] == "test_events.py::test_a"
+        assert (passed["when"], passed["outcome"]) == ("call", "passed")
+        assert passed["letter"] == "✓"
+        assert "location" not in passed
+        assert failed["outcome"] == "failed"
+        assert failed["location"] == "test_events.py:6"
+        assert (skipped["when"], skipped["category"]) == ("setup", "skipped")
+        assert events[-1]["exitstatus"] == 1
+        assert events[-1]["counts"] == {"passed": 1, "failed": 1, "skipped": 1}
+
+    def test_events_flushed_during_test(self, testdir):
+        testdir.makepyfile(
+            """
+            import json
+            import time
+
+            def test_a():
+                pass
+
+            def test_long():
+                time.sleep(1)
+                with open("events.ndjson") as file:
+                    events = [json.loads(line)["event"] for line in file]
+                assert events == ["collection", "test"]
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-events=events.ndjson")
+        assert result.ret == 0
+
+    def test_dedup_failures(self, testdir):
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.fixture
+            def db():
+                raise RuntimeError("db down")
+
+            @pytest.mark.parametrize("i", range(5))
+            def test_db(db, i):
+                pass
+
+            @pytest.mark.parametrize("i", range(3))
+            def test_same(i):
+                assert False, "same"
+
+            @pytest.mark.parametrize("i", range(2))
+            def test_different(i):
+                assert i == -1
+            """
+        )
+        output = testdir.runpytest("--force-sugar").stdout.str()
+        assert output.count('raise RuntimeError("db down")') == 5
+
+        result = testdir.runpytest("--force-sugar", "--sugar-dedup")
+        output = result.stdout.str()
+        assert output.count('raise RuntimeError("db down")') == 1
+        assert output.count('assert False, "same"') == 1
+        assert output.count("assert i == -1") == 2
+        result.stdout.fnmatch_lines(
+            [
+                "*5 failed",
+                "*- test_dedup_failures.py:11 test_same?0? "
+                "(and 2 more with the same error)",
+                "*- test_dedup_failures.py:15 test_different?0?",
+                "*- test_dedup_failures.py:15 test_different?1?",
+                "*5 error",
+                "*- test_dedup_failures.py:7 test_db?0? "
+                "(and 4 more with the same error)",
+            ]
+        )
+
+    def test_playwright_artifacts(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_ui():
+                assert False
+            """
+        )
+        output_dir = testdir.tmpdir.join(
+            "test-results", "test-playwright-artifacts-py-test-ui"
+        )
+        output_dir.join("trace.zip").ensure()
+        output_dir.join("test-failed-1.png").ensure()
+        output_dir.join("video.webm").ensure()
+        result = testdir.runpytest("--force-sugar")
+        result.stdout.fnmatch_lines(
+            [
+                "*- test_playwright_artifacts.py:1 test_ui",
+                "*- 🎭 playwright show-trace test-results/*/trace.zip",
+                "*- 📷 test-results/*/test-failed-1.png",
+                "*- 🎬 test-results/*/video.webm",
+            ]
+        )
+
+    def test_tb_thread(self, testdir):
+        testdir.makepyfile(
+            """
+            def test_a():
+                assert "first" == ""
+
+            def test_b():
+                pass
+
+            def test_c():
+                assert "second" == ""
+
+            def test_d():
+                pass
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-tb-thread")
+        output = result.stdout.str()
+
+        first = output.index('assert "first" == ""')
+        second = output.index('assert "second" == ""')
+        assert output.index(" 25% ") < first < output.index(" 50% ")
+        assert output.index(" 75% ") < second < output.index(" 100% ")
+        assert output.count("Results") == 1
+        assert output.index(" 100% ") < output.index("Results")
+
+    def test_tb_thread_overlap(self, testdir):
+        testdir.makeconftest(
+            """
+            import time
+            import pytest
+
+            class SlowRepr:
+                def toterminal(self, tw):
+                    time.sleep(0.5)
+                    tw.line("slow failure")
+
+            @pytest.hookimpl(hookwrapper=True)
+            def pytest_runtest_makereport(item, call):
+                outcome = yield
+                report = outcome.get_result()
+                if report.failed:
+                    report.longrepr = SlowRepr()
+            """
+        )
+        testdir.makepyfile(
+            """
+            import time
+
+            def test_a():
+                assert False
+
+            def test_b():
+                time.sleep(0.5)
+            """
+        )
+        started = time.monotonic()
+        result = testdir.runpytest("--force-sugar", "--sugar-tb-thread")
+        # The failure is formatted while test_b runs
+        assert time.monotonic() - started < 0.9
+        output = result.stdout.str()
+        assert output.index(" 50% ") < output.index("slow failure")
+        assert output.index("slow failure") < output.index(" 100% ")
+
+    def test_directories(self, testdir):
+        test_file = (
+            "import pytest\n"
+            "@pytest.mark.parametrize('i', range(3))\n"
+            "def test_a(i):\n"
+            "    pass\n"
+        )
+        for directory in ("unit", "unit/api", "e2e"):
+            for i in range(2):
+                name = "test_%s_%d.py" % (directory.replace("/", "_"), i)
+                testdir.tmpdir.join(directory, name).write(test_file, ensure=True)
+        testdir.tmpdir.join("unit", "test_fail.py").write("def test_f(): assert 0")
+        result = testdir.runpytest("--force-sugar", "--sugar-directories", "--tb=no")
+        # The order of the directories depends on the version of pytest
+        for line in (
+            " e2e/ ██████████     6/6     ✓ 6 *",
+            " unit/api/ ██████████     6/6     ✓ 6 *",
+            " unit/ ██████████     7/7     ⨯ 1 ✓ 6 *",
+            "*100% ██████████",
+        ):
+            result.stdout.fnmatch_lines([line])
+        assert "test_unit_0.py" not in result.stdout.str()
+
+    def test_directories_setup_error(self, testdir):
+        testdir.tmpdir.join("unit", "test_a.py").write(
+            "import pytest\n"
+            "@pytest.fixture\n"
+            "def broken():\n"
+            "    raise RuntimeError\n"
+            "def test_a(broken):\n"
+            "    pass\n"
+            "def test_b():\n"
+            "    pass\n",
+            ensure=True,
+        )
+        result = testdir.runpytest("--force-sugar", "--sugar-directories", "--tb=no")
+        result.stdout.fnmatch_lines([" unit/ ██████████     2/2     ✓ 1 *"])
+
+    def test_xdist_workers(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile(
+            """
+            import pytest
+
+            @pytest.mark.parametrize("i", range(4))
+            def test_nada(i):
+                pass
+            """
+        )
+        result = testdir.runpytest("--force-sugar", "-n2", "--sugar-workers")
+
+        assert result.ret == 0, result.stderr.str()
+        result.stdout.fnmatch_lines(
+            [
+                "*[1-9]% *",
+                "Workers (load imbalance *):",
+                "*gw0 *tests*tests/s  busy*",
+                "*gw1 *tests*tests/s  busy*",
+            ]
+        )
+
     def test_xdist_verbose(self, testdir):
         pytest.importorskip("xdist")
         testdir.makepyfile(